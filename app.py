@@ -6,26 +6,76 @@
 @Time    :   2021/2/7 10:07
 @Desc    :
 """
+import time
+
+# 启动计时从导入这个模块开始
+IMPORT_START = time.perf_counter()
+
+import os
+import signal
+import socket
+import traceback
+from inspect import isawaitable
 
 from sanic import Sanic
-from sanic.response import text, json
-import time
+from sanic.response import text, json, stream, json_dumps, HTTPResponse
+from graphql.error import format_error, GraphQLError
+from graphql.execution import ExecutionResult
+from graphql.utils.get_operation_ast import get_operation_ast
 
 from tortoise import Tortoise
 
-from graphene_backend import MyGraphQLBackend
-from graphgl_api import schema, DemoViewSet
+import tracing
+from cache import ResultCache, SingleFlight
+from graphene_backend import MyGraphQLBackend, StreamingResult, get_etag
+from graphene_executor import ListStream
+from graphgl_api import get_schema, DemoViewSet
+from identity_map import IdentityMap
 import asyncio
+from collections import OrderedDict
+from functools import partial
+from contextlib import contextmanager, nullcontext
+from json import loads as json_loads, load as json_load
+
+# 启动各个阶段的用时，单位是秒，见 /metrics/
+startup_timings = OrderedDict([("import", time.perf_counter() - IMPORT_START)])
+
+
+@contextmanager
+def startup_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - start
+
+
+# sqlite的文件，以及只读连接的个数，为0的时候只有一个连接，见 sqlite_pool
+SQLITE_FILE = os.environ.get("SQLITE_FILE", "db.sqlite3")
+SQLITE_READ_CONNECTIONS = int(os.environ.get("SQLITE_READ_CONNECTIONS", 4))
 
 
 async def init_orm(generate_schemas=False):
     # Here we create a SQLite DB using file "db.sqlite3"
     #  also specify the app name of "models"
     #  which contain models from "app.models"
-    await Tortoise.init(
-        db_url='sqlite://db.sqlite3',
-        modules={'models': ["model"]}
-    )
+    await Tortoise.init(config={
+        "connections": {
+            "default": {
+                "engine": "sqlite_pool",
+                "credentials": {
+                    "file_path": SQLITE_FILE,
+                    "read_connections": SQLITE_READ_CONNECTIONS,
+                    # 下面这些是PRAGMA，WAL模式下读不会被写阻塞
+                    "journal_mode": "WAL",
+                    "synchronous": "NORMAL",
+                },
+            },
+        },
+        "apps": {
+            "models": {"models": ["model"], "default_connection": "default"},
+        },
+    })
     # Generate the schema
     if generate_schemas:
         await Tortoise.generate_schemas()
@@ -33,7 +83,46 @@ async def init_orm(generate_schemas=False):
     print("orm初始化完成")
 
 
+# 大于0的时候开启整个查询结果的缓存，单位是秒
+# 缓存只在写数据的那个进程里失效，多进程模式下别的worker要等过期才能看到新数据，见 supervise
+RESULT_CACHE_TTL = float(os.environ.get("GRAPHQL_RESULT_CACHE_TTL", 0))
+RESULT_CACHE_SIZE = int(os.environ.get("GRAPHQL_RESULT_CACHE_SIZE", 1024))
+# 为1的时候合并同时进行的相同查询，见 cache.SingleFlight
+# 默认关掉：合并的请求共用第一个请求的context，只有resolver不看请求的context的时候才能打开，
+# 单个请求可以在context里放 single_flight=False 不参与合并
+SINGLE_FLIGHT = os.environ.get("GRAPHQL_SINGLE_FLIGHT", "0") == "1"
+# 一次批量请求里最多包含多少个查询
+MAX_BATCH_SIZE = int(os.environ.get("GRAPHQL_MAX_BATCH_SIZE", 20))
+# 查询开销和嵌套层数的上限，小于等于0表示不限制，见 query_cost
+# 默认不限制，估计的开销总是放在 extensions.cost 里，可以先按实际的流量定好上限再开启
+MAX_QUERY_COST = float(os.environ.get("GRAPHQL_MAX_QUERY_COST", 0))
+MAX_QUERY_DEPTH = int(os.environ.get("GRAPHQL_MAX_QUERY_DEPTH", 0))
+# 开启之后每个响应带上 extensions.tracing，汇总的直方图见 /metrics/
+TRACING = os.environ.get("GRAPHQL_TRACING", "0") == "1"
+# 中间件会缓存包装过的resolver，所以整个进程共用一个
+middleware = tracing.get_middleware() if TRACING else None
+HOST = os.environ.get("GRAPHQL_HOST", "0.0.0.0")
+PORT = int(os.environ.get("GRAPHQL_PORT", 8000))
+# 大于1的时候fork出多个进程，共用同一个监听端口，见 supervise
+WORKERS = int(os.environ.get("GRAPHQL_WORKERS", 1))
+# 预热用的查询，格式和 /api/ 的批量请求一样，进程在接受请求之前先把它们执行一遍
+WARMUP_FILE = os.environ.get("GRAPHQL_WARMUP_FILE",
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), "warmup_queries.json"))
+# 为1的时候GET请求带上ETag，If-None-Match对得上就直接返回304，见 graphene_backend.get_etag
+# 数据版本号只在进程内有效，多进程模式下别的worker写了数据这个进程不知道，所以默认只在单进程的时候开启
+ETAG = os.environ.get("GRAPHQL_ETAG", "1" if WORKERS <= 1 else "0") == "1"
+# /api/?stream=1 的时候流式输出结果，攒够这么多字节写一次，见 stream_query
+STREAM_CHUNK_SIZE = int(os.environ.get("GRAPHQL_STREAM_CHUNK_SIZE", 64 * 1024))
+# 顶层列表字段每次完成这么多项再写出去，同一批的关系加载仍然会合并
+STREAM_BATCH_SIZE = int(os.environ.get("GRAPHQL_STREAM_BATCH_SIZE", 500))
+
 app = Sanic("hello_example")
+backend = MyGraphQLBackend(
+    result_cache=ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL) if RESULT_CACHE_TTL > 0 else None,
+    max_cost=MAX_QUERY_COST if MAX_QUERY_COST > 0 else None,
+    max_depth=MAX_QUERY_DEPTH if MAX_QUERY_DEPTH > 0 else None,
+    single_flight=SingleFlight() if SINGLE_FLIGHT else None,
+)
 
 
 @app.route("/")
@@ -42,22 +131,375 @@ async def ping(request):
                  "time": time.time()})
 
 
+async def execute_query(params, shared=None):
+    if not TRACING:
+        return await do_execute_query(params, shared)
+    with tracing.trace() as tracer:
+        ret = await do_execute_query(params, shared)
+        # 缓存的结果共用extensions，这里要复制一份再改
+        ret["extensions"] = dict(ret.get("extensions", {}), tracing=tracer.to_dict())
+    return ret
+
+
+def get_request_etag(params):
+    if not isinstance(params, dict) or not isinstance(params.get("query"), str):
+        return None
+    variables = params.get("variables")
+    try:
+        variables = json_loads(variables) if variables else None
+    except ValueError:
+        return None
+    return get_etag(backend, get_schema(), params.get("query"), variables, params.get("operationName"))
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match 是 * 或者逗号分隔的多个ETag，按弱比较
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    def strip(x):
+        x = x.strip()
+        return x[2:] if x.startswith("W/") else x
+
+    return strip(etag) in {strip(i) for i in if_none_match.split(",")}
+
+
+def params_error():
+    return {"errors": [{"message": "请求的格式应该是 {query, variables, operationName}"}]}
+
+
+async def get_result(params, shared=None, stream=False):
+    variables = params.get("variables")
+    if isinstance(variables, str):
+        try:
+            variables = json_loads(variables) if variables else None
+        except ValueError:
+            # 只让这一个查询出错，批量请求里别的查询照常返回
+            return ExecutionResult(errors=[GraphQLError("variables 不是有效的json")], invalid=True)
+    context = {}
+    if shared is not None:
+        # 同一批的查询共用加载器和identity map，相同的关系加载会被合并，见 get_batch_context
+        # prefetch计划是按action_id存的，不能共用
+        context.update(shared)
+    result = get_schema().execute(params.get("query"), backend=backend, context_value=context,
+                                  variable_values=variables, operation_name=params.get("operationName"),
+                                  middleware=middleware, stream=stream)
+    # 语法错误的时候graphql直接返回结果，而不是awaitable
+    if isawaitable(result):
+        result = await result
+    return result
+
+
+def result_to_dict(result):
+    ret = result.to_dict()
+    if result.extensions:
+        ret["extensions"] = result.extensions
+    return ret
+
+
+async def do_execute_query(params, shared=None):
+    if not isinstance(params, dict):
+        return params_error()
+    result = await get_result(params, shared)
+    with tracing.phase("serialize"):
+        return result_to_dict(result)
+
+
+class ChunkWriter:
+    """
+    把小段的字符串攒成一块再写进流式响应，写的时候会等待对方接收，所以缓冲不会无限增长
+    """
+
+    def __init__(self, response, chunk_size=STREAM_CHUNK_SIZE):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+
+    async def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            await self.flush()
+
+    async def flush(self):
+        if self.parts:
+            data = "".join(self.parts)
+            self.parts = []
+            self.size = 0
+            await self.response.write(data)
+
+
+def iter_json(value):
+    # 列表一项一项地序列化，不会一次生成整个列表的字符串
+    if not isinstance(value, list):
+        yield json_dumps(value)
+        return
+    yield "["
+    for i, item in enumerate(value):
+        if i:
+            yield ","
+        yield json_dumps(item)
+    yield "]"
+
+
+async def write_list_stream(writer, value, batch_size=STREAM_BATCH_SIZE):
+    # 顶层的列表字段一批一批地完成，每一批写出去之后就不再引用
+    items = await value.resolve()
+    if items is None:
+        await writer.write("null")
+        return
+    await writer.write("[")
+    index = 0
+    # 写失败（客户端断开）的时候也要关掉，还没查询的段就不会再查询了
+    iterator = value.iter_items(items, batch_size)
+    try:
+        async for item in iterator:
+            await writer.write(("," if index else "") + json_dumps(item))
+            index += 1
+    finally:
+        await iterator.aclose()
+    await writer.write("]")
+
+
+async def write_streaming_result(writer, result, tracer=None):
+    """
+    按顶层字段的顺序，每个字段完成之后马上写出去，写完就不再引用它的结果
+    errors 和 extensions 要等所有字段都完成才知道，所以放在data后面
+    执行和输出是交替进行的，和非流式的执行一样记在 execute 阶段里
+    """
+    data = result.data
+    with tracing.phase("execute"):
+        await writer.write('{"data":{')
+        for index, name in enumerate(list(data)):
+            value = data.pop(name)
+            await writer.write(("," if index else "") + json_dumps(name) + ":")
+            if isinstance(value, ListStream):
+                await write_list_stream(writer, value)
+                continue
+            if isawaitable(value):
+                try:
+                    value = await value
+                except Exception as e:
+                    # 非空的顶层字段出错，前面的字段已经写出去了，只能把这个字段写成null
+                    result.errors.append(e)
+                    value = None
+            for part in iter_json(value):
+                await writer.write(part)
+        await writer.write("}")
+    if result.errors:
+        await writer.write(',"errors":' + json_dumps([format_error(e) for e in result.errors]))
+    extensions = result.extensions
+    if tracer is not None:
+        extensions = dict(extensions or {}, tracing=tracer.to_dict())
+    if extensions:
+        await writer.write(',"extensions":' + json_dumps(extensions))
+    await writer.write("}")
+
+
+async def stream_query(response, params):
+    """
+    流式执行一个查询，响应体和 /api/ 的json一样，只是键的顺序是 data、errors、extensions
+    变更和出错的查询没有可以流式输出的东西，整个写出去
+    """
+    writer = ChunkWriter(response)
+    with (tracing.trace() if TRACING else nullcontext()) as tracer:
+        result = await get_result(params, stream=True) if isinstance(params, dict) else None
+        if isinstance(result, StreamingResult):
+            try:
+                await write_streaming_result(writer, result, tracer)
+            finally:
+                # 写失败的时候剩下的字段还在执行，取消掉
+                result.cancel()
+        else:
+            ret = params_error() if result is None else result_to_dict(result)
+            if tracer is not None:
+                ret["extensions"] = dict(ret.get("extensions", {}), tracing=tracer.to_dict())
+            await writer.write(json_dumps(ret))
+    await writer.flush()
+
+
+@app.route("/metrics/")
+async def metrics(request):
+    pools = {name: connection.pool_stats() for name, connection in Tortoise._connections.items()
+             if hasattr(connection, "pool_stats")}
+    single_flight = backend.execute_params["single_flight"]
+    return json({"histograms": tracing.export_histograms(), "pools": pools,
+                 "single_flight": single_flight.stats() if single_flight is not None else None,
+                 "startup": {k: round(v * 1000, 3) for k, v in startup_timings.items()}})
+
+
+def is_mutation(params):
+    # 解析不了的查询不会被执行，当作不是变更
+    if not isinstance(params, dict) or not isinstance(params.get("query"), str):
+        return False
+    try:
+        document_ast, _ = backend.parse_and_validate(get_schema(), params["query"])
+    except GraphQLError:
+        return False
+    operation = get_operation_ast(document_ast, params.get("operationName"))
+    return operation is not None and operation.operation == "mutation"
+
+
+def get_batch_context(body):
+    """
+    一批查询共用的加载器和identity map，加载器在这一批的identity map里去重，而不是第一个查询的
+    批里有变更的时候不共用：变更和查询同时执行，加载器缓存的结果可能是变更之前的
+    """
+    if any(is_mutation(i) for i in body):
+        return None
+    return {"loaders": {}, "identity_map": IdentityMap()}
+
+
+def wants_stream(request):
+    # 批量请求不支持流式输出
+    return request.args.get("stream") in ("1", "true")
+
+
 @app.route("/api/", methods=["GET", "POST"])
 async def api(request):
     if request.method == "GET":
-        query_str = request.args.get("query")
-    else:
-        assert request.method == "POST"
-        query_str = request.json.get("query")
-    result = await schema.execute(query_str, backend=MyGraphQLBackend())
-    return json(result.to_dict())
+        # 数据没有变化的话不执行任何resolver，直接返回304
+        etag = get_request_etag(request.args) if ETAG else None
+        if etag is not None and etag_matches(request.headers.get("If-None-Match"), etag):
+            return HTTPResponse(status=304, headers={"ETag": etag})
+        if wants_stream(request):
+            # 流式响应在执行之前就要发出响应头，不知道会不会出错，所以不带ETag
+            return stream(partial(stream_query, params=request.args), content_type="application/json")
+        result = await execute_query(request.args)
+        if etag is None or "errors" in result:
+            return json(result)
+        return json(result, headers={"ETag": etag})
+    assert request.method == "POST"
+    body = request.json
+    if not isinstance(body, list):
+        if wants_stream(request):
+            return stream(partial(stream_query, params=body), content_type="application/json")
+        return json(await execute_query(body))
+    # 批量请求，所有查询在事件循环上并发执行，结果按原来的顺序返回
+    if len(body) > MAX_BATCH_SIZE:
+        return json({"errors": [{"message": f"一次最多{MAX_BATCH_SIZE}个查询"}]}, status=400)
+    shared = get_batch_context(body)
+    results = await asyncio.gather(*[execute_query(i, shared) for i in body])
+    return json(results)
 
 
-async def main():
-    await init_orm()
-    server = await app.create_server(host="0.0.0.0", port=8000, return_asyncio_server=True)
+def load_warmup_queries(path=WARMUP_FILE):
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return json_load(f)
+
+
+async def warmup(queries):
+    # 填充文档缓存、prefetch计划缓存、开销缓存，顺便让每个字段的resolver完成编译
+    start = time.perf_counter()
+    for i in queries:
+        result = await execute_query(i)
+        if "errors" in result:
+            print(f"预热查询出错: {result['errors']}")
+    print(f"预热完成，执行了{len(queries)}个查询，用时{time.perf_counter() - start:.3f}秒")
+
+
+async def serve(sock=None):
+    if "schema" not in startup_timings:
+        # 多进程模式下schema在fork之前已经构建好了
+        with startup_phase("schema"):
+            get_schema()
+    with startup_phase("init_orm"):
+        await init_orm()
+    with startup_phase("warmup"):
+        await warmup(load_warmup_queries())
+    with startup_phase("listen"):
+        if sock is None:
+            server = await app.create_server(host=HOST, port=PORT, return_asyncio_server=True)
+        else:
+            server = await app.create_server(sock=sock, return_asyncio_server=True)
+    startup_timings["total"] = time.perf_counter() - IMPORT_START
+    print("启动用时: " + ", ".join(f"{k} {v:.3f}s" for k, v in startup_timings.items()))
     await server.wait_closed()
 
 
+def spawn_worker(sock):
+    pid = os.fork()
+    if pid:
+        return pid
+    # 子进程，信号处理恢复成默认的，被supervisor杀掉的时候直接退出
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        asyncio.run(serve(sock))
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def supervise(workers=WORKERS):
+    """
+    监听端口之后fork出workers个进程，schema在fork之前已经构建好了
+    有进程退出的话重新启动一个，收到SIGTERM或SIGINT的时候结束所有进程
+    数据版本号、结果缓存和count缓存都是每个进程自己的，一个worker写了数据，别的worker不知道：
+    ETag默认关掉，结果缓存和 BaseCURD.count_cache_ttl 要能接受在过期之前读到旧数据才可以开启
+    """
+    with startup_phase("schema"):
+        get_schema()
+    cached_counts = [i.get_name() for i in DemoViewSet.curds if i.count_cache_ttl > 0]
+    if RESULT_CACHE_TTL > 0 or cached_counts:
+        print(f"注意: 多进程模式下结果缓存（{RESULT_CACHE_TTL}秒）和count缓存（{', '.join(cached_counts) or '无'}）"
+              "不会因为别的worker写了数据而失效，过期之前可能返回旧数据")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(100)
+    sock.set_inheritable(True)
+
+    # pid -> 启动的时间
+    children = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        children[spawn_worker(sock)] = time.monotonic()
+    print(f"启动了{workers}个worker: {list(children)}")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        if time.monotonic() - started < 1:
+            # 一启动就崩溃的话，不要疯狂地重启
+            time.sleep(1)
+        new_pid = spawn_worker(sock)
+        children[new_pid] = time.monotonic()
+        print(f"worker {pid} 退出了，状态是{status}，重新启动为 {new_pid}")
+    sock.close()
+
+
+async def main():
+    await serve()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if WORKERS > 1:
+        supervise(WORKERS)
+    else:
+        asyncio.run(main())
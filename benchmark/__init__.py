@@ -0,0 +1,8 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   __init__.py
+@Time    :   2021/3/9 10:20
+@Desc    :   压测，用法见 python -m benchmark --help
+"""
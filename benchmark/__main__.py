@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   __main__.py
+@Time    :   2021/3/9 11:30
+@Desc    :   python -m benchmark 生成数据、压测，输出json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from tortoise import Tortoise
+
+from benchmark.queries import QUERIES
+from benchmark.runner import run_in_process, run_http, peak_rss_kb
+from benchmark.seed import seed_database
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="生成数据并压测graphql接口")
+    parser.add_argument("--mode", choices=("in-process", "http", "both"), default="both")
+    parser.add_argument("--url", help="压测已经启动的服务，比如 http://127.0.0.1:8000/api/，这时不会生成数据")
+    parser.add_argument("--transport", choices=("socket", "asgi"), default="socket",
+                        help="http压测本进程里的app时，监听端口还是直接走asgi")
+    parser.add_argument("--db", help="sqlite文件的路径，默认用临时文件")
+    parser.add_argument("--read-connections", type=int, default=4, help="sqlite只读连接的个数，0表示只有一个连接")
+    parser.add_argument("--tournaments", type=int, default=20)
+    parser.add_argument("--events-per-tournament", type=int, default=20)
+    parser.add_argument("--teams", type=int, default=200)
+    parser.add_argument("--participants-per-event", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("--iterations", type=int, default=200, help="每个查询执行的次数")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--queries", help="逗号分隔的查询名，可选：" + ",".join(QUERIES))
+    parser.add_argument("--fast-read", action="store_true", help="demo的curd都打开 BaseCURD.fast_read")
+    parser.add_argument("--output", help="结果写到这个文件，默认输出到标准输出")
+    return parser.parse_args(argv)
+
+
+async def main(args):
+    queries = QUERIES
+    if args.queries:
+        names = [i.strip() for i in args.queries.split(",") if i.strip()]
+        unknown = set(names) - set(QUERIES)
+        assert not unknown, f"没有这些查询: {','.join(sorted(unknown))}"
+        queries = {k: QUERIES[k] for k in names}
+
+    report = {
+        "meta": {
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": {k: v for k, v in vars(args).items() if k != "output"},
+        },
+        "results": {},
+    }
+
+    if args.fast_read:
+        from graphgl_api import DemoViewSet
+        for curd in DemoViewSet.curds:
+            curd.fast_read = True
+
+    db_dir = None
+    db = args.db
+    if db is None:
+        db_dir = tempfile.TemporaryDirectory()
+        db = os.path.join(db_dir.name, "bench.sqlite3")
+    elif os.path.exists(db):
+        os.remove(db)
+    await Tortoise.init(config={
+        "connections": {
+            "default": {
+                "engine": "sqlite_pool",
+                "credentials": {"file_path": db, "read_connections": args.read_connections,
+                                "journal_mode": "WAL", "synchronous": "NORMAL"},
+            },
+        },
+        "apps": {"models": {"models": ["model"], "default_connection": "default"}},
+    })
+    try:
+        if args.url is None:
+            await Tortoise.generate_schemas()
+            report["meta"]["rows"] = await seed_database(
+                args.tournaments, args.events_per_tournament, args.teams,
+                args.participants_per_event, args.seed
+            )
+        if args.mode in ("in-process", "both") and args.url is None:
+            report["results"]["in_process"] = await run_in_process(
+                queries, args.iterations, args.concurrency, args.warmup
+            )
+        if args.mode in ("http", "both"):
+            report["results"]["http"] = await run_http(
+                queries, args.iterations, args.concurrency, args.warmup, args.url, args.transport
+            )
+        report["pool"] = Tortoise.get_connection("default").pool_stats()
+    finally:
+        await Tortoise.close_connections()
+        if db_dir is not None:
+            db_dir.cleanup()
+    report["peak_rss_kb"] = peak_rss_kb()
+    return report
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = asyncio.run(main(args))
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
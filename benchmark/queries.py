@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   queries.py
+@Time    :   2021/3/9 10:40
+@Desc    :   压测用的查询，覆盖平铺的列表、深层嵌套、计数和按主键查询
+"""
+from collections import OrderedDict, namedtuple
+
+BenchQuery = namedtuple("BenchQuery", ("query", "variables"))
+
+QUERIES = OrderedDict([
+    ("flat_list", BenchQuery("{ eventList(pageSize: 100) { id name } }", None)),
+    ("flat_page", BenchQuery("{ teamPage(first: 100) { items { id name } endCursor hasNextPage } }", None)),
+    ("nested", BenchQuery(
+        "{ tournamentList(pageSize: 10) { id name events { id name participants { id name } } } }", None
+    )),
+    ("nested_first", BenchQuery(
+        '{ tournamentList(pageSize: 10) { id name eventsCount events(first: 3, orderBy: "-id") '
+        '{ id name participants(first: 2) { id name } } } }', None
+    )),
+    ("deep", BenchQuery(
+        "{ eventList(pageSize: 10) { name tournament { name events { name participants { name events { name } } } } } }",
+        None
+    )),
+    ("count", BenchQuery("{ tournamentCount eventCount teamCount }", None)),
+    ("retrieve", BenchQuery(
+        "query ($pk: Int) { eventRetrieve(pk: $pk) { id name tournament { id name } participants { id name } } }",
+        {"pk": 1}
+    )),
+])
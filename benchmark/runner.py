@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   runner.py
+@Time    :   2021/3/9 11:00
+@Desc    :   分别在进程内和通过http重放查询，统计吞吐量、延迟和sql条数
+"""
+import asyncio
+import math
+import resource
+import socket
+import time
+from inspect import isawaitable
+from typing import Callable, Awaitable, Dict, List, Optional
+
+import tracing
+from benchmark.queries import BenchQuery
+
+# 执行一个查询，返回是否出错
+Execute = Callable[[BenchQuery], Awaitable[bool]]
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    # 最近秩法
+    if not sorted_values:
+        return 0.0
+    index = max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def peak_rss_kb() -> int:
+    # linux上的单位是KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summarize(latencies: List[float], wall_time: float, errors: int):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / wall_time, 2) if wall_time > 0 else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+    }
+
+
+async def measure(execute: Execute, query: BenchQuery, iterations: int, concurrency: int):
+    """
+    concurrency个协程一起跑，总共执行iterations次
+    """
+    latencies = []
+    errors = 0
+    remaining = iterations
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            ok = await execute(query)
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(max(min(concurrency, iterations), 1))])
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+async def count_sql(execute: Execute, query: BenchQuery) -> int:
+    # 单独执行一次，数一下发出了多少条sql
+    with tracing.trace() as tracer:
+        await execute(query)
+    return tracer.sql_count
+
+
+async def run_queries(execute: Execute, queries: Dict[str, BenchQuery], iterations: int,
+                      concurrency: int, warmup: int = 5, sql_execute: Optional[Execute] = None):
+    ret = {}
+    for name, query in queries.items():
+        for _ in range(warmup):
+            await execute(query)
+        stats = await measure(execute, query, iterations, concurrency)
+        if sql_execute is not None:
+            stats["sql_per_query"] = await count_sql(sql_execute, query)
+        ret[name] = stats
+    return ret
+
+
+def in_process_executor() -> Execute:
+    from graphene_backend import MyGraphQLBackend
+    from graphgl_api import get_schema
+
+    schema = get_schema()
+    backend = MyGraphQLBackend()
+
+    async def execute(query: BenchQuery) -> bool:
+        result = schema.execute(query.query, backend=backend, context_value={},
+                                variable_values=query.variables)
+        if isawaitable(result):
+            result = await result
+        return not result.errors
+
+    return execute
+
+
+async def run_in_process(queries: Dict[str, BenchQuery], iterations: int, concurrency: int, warmup: int = 5):
+    execute = in_process_executor()
+    return await run_queries(execute, queries, iterations, concurrency, warmup, sql_execute=execute)
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def run_http(queries: Dict[str, BenchQuery], iterations: int, concurrency: int,
+                   warmup: int = 5, url: Optional[str] = None, transport: str = "socket"):
+    """
+    url为None的时候在当前事件循环上启动app，否则压测url指向的服务
+    transport为asgi的时候不监听端口，请求经由asgi直接交给app，仍然会走完整的sanic请求处理
+    sql条数是在进程内统计的，和传输方式无关
+    """
+    import httpx
+
+    assert transport in ("socket", "asgi"), f"不支持的transport: {transport}"
+    server = None
+    client_kwargs = {"timeout": 60}
+    local = url is None
+    if local:
+        from app import app
+        if transport == "asgi":
+            client_kwargs["app"] = app
+            url = "http://benchmark/api/"
+        else:
+            port = get_free_port()
+            server = await app.create_server(host="127.0.0.1", port=port, access_log=False,
+                                             return_asyncio_server=True)
+            url = f"http://127.0.0.1:{port}/api/"
+    if transport == "socket":
+        client_kwargs["limits"] = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    try:
+        async with httpx.AsyncClient(**client_kwargs) as client:
+            async def execute(query: BenchQuery) -> bool:
+                response = await client.post(url, json={"query": query.query, "variables": query.variables})
+                return response.status_code == 200 and "errors" not in response.json()
+
+            return await run_queries(execute, queries, iterations, concurrency, warmup,
+                                     sql_execute=in_process_executor() if local else None)
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   seed.py
+@Time    :   2021/3/9 10:25
+@Desc    :   生成压测用的数据，同样的参数生成的数据总是一样的
+"""
+import random
+
+from model import Tournament, Event, Team
+
+
+async def seed_database(tournaments=20, events_per_tournament=20, teams=200,
+                        participants_per_event=5, random_seed=0):
+    """
+    库必须是空的，表由调用者生成
+    返回各个表的行数
+    """
+    assert participants_per_event <= teams, "每个比赛的参赛队伍不能比队伍总数多"
+    rnd = random.Random(random_seed)
+    await Team.bulk_create([Team(name=f"team{i}") for i in range(teams)])
+    await Tournament.bulk_create([Tournament(name=f"tournament{i}") for i in range(tournaments)])
+    tournament_ids = await Tournament.all().order_by("id").values_list("id", flat=True)
+    await Event.bulk_create([
+        Event(name=f"event{t}-{e}", tournament_id=tournament_id)
+        for t, tournament_id in enumerate(tournament_ids)
+        for e in range(events_per_tournament)
+    ])
+    event_ids = await Event.all().order_by("id").values_list("id", flat=True)
+    team_ids = await Team.all().order_by("id").values_list("id", flat=True)
+
+    # 多对多的关系直接批量写中间表，逐个add太慢了
+    field = Event._meta.fields_map["participants"]
+    rows = [[event_id, team_id]
+            for event_id in event_ids
+            for team_id in rnd.sample(team_ids, participants_per_event)]
+    await Event._meta.db.execute_many(
+        f'INSERT INTO "{field.through}" ("{field.backward_key}", "{field.forward_key}") VALUES (?, ?)', rows
+    )
+    return {
+        "tournament": len(tournament_ids),
+        "event": len(event_ids),
+        "team": len(team_ids),
+        field.through: len(rows),
+    }
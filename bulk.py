@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   bulk.py
+@Time    :   2021/3/12 10:10
+@Desc    :   批量写，每一批是一条多行的 INSERT/UPDATE/DELETE，调用者负责把它们放在同一个事务里
+"""
+from typing import Type, List, Dict, Any, Set, Iterable
+
+from pypika import Table
+from pypika.terms import Case
+from tortoise import Model
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from model_version import get_cascade_tables
+
+# 一条sql里参数个数的上限，sqlite 3.32之前默认是999
+MAX_SQL_PARAMETERS = 999
+
+
+def chunk(items: list, size: int) -> Iterable[list]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_batch_size(batch_size: int, parameters_per_row: int) -> int:
+    # 每一批的行数，不能让一条sql的参数超过上限
+    return max(1, min(batch_size, MAX_SQL_PARAMETERS // max(parameters_per_row, 1)))
+
+
+def get_m2m_values(model: Type[Model], item: Dict[str, Any]) -> Dict[str, List[Any]]:
+    # 把多对多字段从item里拿出来，值是关联对象主键的列表
+    return {k: list(item.pop(k) or []) for k in list(item) if k in model._meta.m2m_fields}
+
+
+def check_nulls(model: Type[Model], item: Dict[str, Any]):
+    # 在执行任何sql之前拒绝写进非空列的null，否则要到数据库报错，事务已经写了一半
+    fields_map = model._meta.fields_map
+    nulls = sorted(k for k, v in item.items() if v is None and k in fields_map and not fields_map[k].null)
+    if nulls:
+        raise ValueError(f"{model.__name__} 的这些字段不能为null: {','.join(nulls)}")
+
+
+def get_executor(model: Type[Model], db: BaseDBAsyncClient):
+    # 借用tortoise的执行器取得可以插入的列，以及每一列转换成数据库的值的函数
+    return db.executor_class(model=model, db=db)
+
+
+def get_written_tables(model: Type[Model], m2m_fields: Iterable[str] = (), cascade=False) -> Set[str]:
+    """
+    批量写不会触发tortoise的信号，调用者要自己给这些表加版本号，见 model_version.bump_on
+    cascade为True的时候（删除）还包括数据库级联删除会写到的表
+    """
+    meta_info = model._meta
+    tables = {meta_info.db_table} | {meta_info.fields_map[i].through for i in m2m_fields}
+    if cascade:
+        tables |= get_cascade_tables(model)
+    return tables
+
+
+async def insert_m2m_links(model: Type[Model], db: BaseDBAsyncClient, field_name: str,
+                           links: List[List[Any]], batch_size: int):
+    # links 是 [本模型的主键, 关联对象的主键] 的列表，写进中间表
+    field = model._meta.fields_map[field_name]
+    executor = get_executor(model, db)
+    through = Table(field.through)
+    for rows in chunk(links, get_batch_size(batch_size, 2)):
+        query = db.query_class.into(through).columns(field.backward_key, field.forward_key)
+        for _ in rows:
+            query = query.insert(executor.parameter(0), executor.parameter(1))
+        await db.execute_insert(str(query), [i for row in rows for i in row])
+
+
+async def delete_m2m_links(model: Type[Model], db: BaseDBAsyncClient, field_name: str,
+                           pks: List[Any], batch_size: int):
+    field = model._meta.fields_map[field_name]
+    executor = get_executor(model, db)
+    through = Table(field.through)
+    for rows in chunk(pks, get_batch_size(batch_size, 1)):
+        query = db.query_class.from_(through) \
+            .where(through[field.backward_key].isin([executor.parameter(0) for _ in rows])).delete()
+        await db.execute_query(str(query), rows)
+
+
+async def select_existing_pks(model: Type[Model], db: BaseDBAsyncClient, pks: List[Any]) -> List[Any]:
+    meta_info = model._meta
+    executor = get_executor(model, db)
+    table = meta_info.basetable
+    query = db.query_class.from_(table).select(table[meta_info.db_pk_column]) \
+        .where(table[meta_info.db_pk_column].isin([executor.parameter(0) for _ in pks]))
+    _, rows = await db.execute_query(str(query), list(pks))
+    existing = {row[0] for row in rows}
+    return [i for i in pks if i in existing]
+
+
+async def bulk_insert(model: Type[Model], items: List[Dict[str, Any]], db: BaseDBAsyncClient,
+                      batch_size: int = 500) -> List[Any]:
+    """
+    items 的key是模型的字段名（外键用 xxx_id），多对多字段的值是关联对象主键的列表
+    没有给主键的行，每一批是一条 INSERT ... VALUES (...), (...)，新的主键由最后插入的id推算
+    返回新行的主键，顺序和items一样
+    """
+    meta_info = model._meta
+    dialect = db.capabilities.dialect
+    assert dialect in ("sqlite", "mysql"), f"批量插入不支持 {dialect}"
+    executor = get_executor(model, db)
+    pks: List[Any] = [None] * len(items)
+    m2m_values = []
+    # 是否给了主键 -> [(下标, 实例)]
+    groups = {True: [], False: []}
+    for index, item in enumerate(items):
+        item = dict(item)
+        m2m_values.append(get_m2m_values(model, item))
+        check_nulls(model, item)
+        # 用模型来校验字段并且填上默认值
+        instance = model(**item)
+        if instance._custom_generated_pk or not meta_info.pk.generated:
+            pks[index] = instance.pk
+            groups[True].append((index, instance))
+        else:
+            groups[False].append((index, instance))
+
+    for custom_pk, instances in groups.items():
+        if not instances:
+            continue
+        columns = executor.regular_columns_all if custom_pk else executor.regular_columns
+        db_columns = [meta_info.fields_db_projection[i] for i in columns]
+        for rows in chunk(instances, get_batch_size(batch_size, len(columns))):
+            query = db.query_class.into(meta_info.basetable).columns(*db_columns)
+            values = []
+            for _, instance in rows:
+                query = query.insert(*[executor.parameter(i) for i in range(len(columns))])
+                values.extend(executor.column_map[i](getattr(instance, i), instance) for i in columns)
+            last_id = await db.execute_insert(str(query), values)
+            if not custom_pk:
+                # 同一条语句插入的行自增id是连续的，sqlite返回最后一行的id，mysql返回第一行的
+                first_id = last_id if dialect == "mysql" else last_id - len(rows) + 1
+                for offset, (index, _) in enumerate(rows):
+                    pks[index] = first_id + offset
+
+    links: Dict[str, List[List[Any]]] = {}
+    for pk, values in zip(pks, m2m_values):
+        for field_name, related_pks in values.items():
+            links.setdefault(field_name, []).extend([pk, i] for i in related_pks)
+    for field_name, rows in links.items():
+        await insert_m2m_links(model, db, field_name, rows, batch_size)
+    return pks
+
+
+async def bulk_update(model: Type[Model], items: List[Dict[str, Any]], db: BaseDBAsyncClient,
+                      batch_size: int = 500) -> List[Any]:
+    """
+    每个item必须有主键，只更新给出的字段，多对多字段给出的话会替换掉原来的关联
+    给出的字段相同的行为一组，每一批是一条 UPDATE ... SET a = CASE pk WHEN ... END WHERE pk IN (...)
+    返回存在并且被更新的行的主键，不存在的主键会被忽略
+    """
+    meta_info = model._meta
+    pk_attr = meta_info.pk_attr
+    executor = get_executor(model, db)
+    table = meta_info.basetable
+    pk_column = table[meta_info.db_pk_column]
+
+    rows = []
+    for item in items:
+        item = dict(item)
+        assert pk_attr in item, f"批量更新的每一行都要有 {pk_attr}"
+        m2m = get_m2m_values(model, item)
+        pk = item.pop(pk_attr)
+        unknown = set(item) - set(executor.column_map)
+        if unknown:
+            raise ValueError(f"{model.__name__} 没有这些字段: {','.join(sorted(unknown))}")
+        check_nulls(model, item)
+        # 和插入一样用实例来转换，有的转换函数会读写实例上的字段；没有给出的字段不会被更新
+        instance = model(**item)
+        rows.append((pk, item, instance, m2m))
+
+    existing = set()
+    for pks in chunk([i[0] for i in rows], get_batch_size(batch_size, 1)):
+        existing.update(await select_existing_pks(model, db, pks))
+    rows = [i for i in rows if i[0] in existing]
+
+    # 要更新的列 -> 行
+    groups: Dict[tuple, list] = {}
+    for pk, item, instance, _ in rows:
+        if item:
+            groups.setdefault(tuple(sorted(item)), []).append((pk, instance))
+    for columns, group in groups.items():
+        for batch in chunk(group, get_batch_size(batch_size, len(columns) * 2 + 1)):
+            query = db.query_class.update(table)
+            values = []
+            for column in columns:
+                case = Case()
+                for pk, instance in batch:
+                    case = case.when(pk_column == executor.parameter(0), executor.parameter(1))
+                    values.extend([pk, executor.column_map[column](getattr(instance, column), instance)])
+                query = query.set(meta_info.fields_db_projection[column], case)
+            query = query.where(pk_column.isin([executor.parameter(0) for _ in batch]))
+            values.extend(pk for pk, _ in batch)
+            await db.execute_query(str(query), values)
+
+    m2m_rows: Dict[str, list] = {}
+    for pk, _, _, m2m in rows:
+        for field_name, related_pks in m2m.items():
+            m2m_rows.setdefault(field_name, []).append((pk, related_pks))
+    for field_name, field_rows in m2m_rows.items():
+        await delete_m2m_links(model, db, field_name, [pk for pk, _ in field_rows], batch_size)
+        links = [[pk, i] for pk, related_pks in field_rows for i in related_pks]
+        await insert_m2m_links(model, db, field_name, links, batch_size)
+    return [i[0] for i in rows]
+
+
+async def bulk_delete(model: Type[Model], pks: List[Any], db: BaseDBAsyncClient,
+                      batch_size: int = 500) -> List[Any]:
+    """
+    每一批是一条 DELETE ... WHERE pk IN (...)
+    中间表和反向外键的行靠数据库的级联删除，和tortoise的 Model.delete 一样
+    返回存在并且被删除的行的主键
+    """
+    meta_info = model._meta
+    executor = get_executor(model, db)
+    table = meta_info.basetable
+    ret = []
+    for batch in chunk(list(dict.fromkeys(pks)), get_batch_size(batch_size, 1)):
+        batch = await select_existing_pks(model, db, batch)
+        if not batch:
+            continue
+        query = db.query_class.from_(table) \
+            .where(table[meta_info.db_pk_column].isin([executor.parameter(0) for _ in batch])).delete()
+        await db.execute_query(str(query), batch)
+        ret.extend(batch)
+    return ret
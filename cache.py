@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   cache.py
+@Time    :   2021/3/1 10:12
+@Desc    :   进程内的缓存
+"""
+import asyncio
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Hashable, Optional, Iterable, Callable, Awaitable, Dict
+
+import model_version
+
+# 用来区分“没有缓存”和“缓存了None”
+MISSING = type("MISSING", (object,), {"__str__": lambda self: "MISSING"})()
+
+
+def freeze(value: Any) -> Hashable:
+    """
+    把变量之类的嵌套结构转换成可以作为key的形式
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(i) for i in value)
+    if isinstance(value, set):
+        return frozenset(freeze(i) for i in value)
+    return value
+
+
+class LRUCache:
+    """
+    有容量上限的LRU缓存，记录命中和未命中的次数
+    ttl不为None的时候，条目过期之后视为不存在，单位是秒
+    """
+
+    def __init__(self, maxsize=256, ttl: Optional[float] = None):
+        assert maxsize > 0, "容量必须大于0"
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (过期时间, 值)
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        try:
+            expire_at, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expire_at is not None and expire_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        if ttl is None:
+            ttl = self.ttl
+        expire_at = None if ttl is None else time.monotonic() + ttl
+        self._data[key] = (expire_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        return item[1]
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResultCache:
+    """
+    整个查询结果的缓存，每个条目记下它读过的表
+    表被写的时候（见 model_version），读过它的条目都会被清掉
+    """
+
+    def __init__(self, maxsize=1024, ttl: Optional[float] = 60):
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        # 表名 -> 读过这个表的key
+        self._keys_by_table = defaultdict(set)
+        self.evictions = 0
+        model_version.add_listener(self.invalidate)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        return self.cache.get(key, default)
+
+    def set(self, key: Hashable, value: Any, tables: Iterable[str]):
+        self.cache.set(key, value)
+        for table in tables:
+            keys = self._keys_by_table[table]
+            keys.add(key)
+            if len(keys) > 2 * self.cache.maxsize:
+                # 被LRU挤掉的key还留在索引里，积累多了清理一下
+                keys.intersection_update(self.cache._data.keys())
+
+    def invalidate(self, table: str):
+        for key in self._keys_by_table.pop(table, ()):
+            if key in self.cache:
+                self.cache.pop(key)
+                self.evictions += 1
+
+    def clear(self):
+        self.cache.clear()
+        self._keys_by_table.clear()
+        self.evictions = 0
+
+    def stats(self):
+        ret = self.cache.stats()
+        ret["evictions"] = self.evictions
+        return ret
+
+
+class SingleFlight:
+    """
+    合并同时进行的相同查询：同一个key同时只执行一次，其他的请求等待同一个结果
+    执行完成之后就不再保留结果，所以不会返回旧的数据，这一点和 ResultCache 不同
+    执行放在单独的任务里，发起它的请求被取消了也不影响其他在等待的请求
+    key里只有查询本身，共用的那次执行用的是第一个请求的context，
+    所以只有resolver不依赖请求的context（用户、权限等）的时候才是安全的
+    """
+
+    def __init__(self):
+        # key -> 正在执行的任务
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        # 真正执行的次数
+        self.executions = 0
+        # 被合并、直接等待别人结果的次数
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Awaitable]) -> Awaitable:
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return asyncio.shield(task)
+        task = asyncio.ensure_future(fn())
+        self._in_flight[key] = task
+        self.executions += 1
+
+        def done(_):
+            if self._in_flight.get(key) is task:
+                del self._in_flight[key]
+
+        task.add_done_callback(done)
+        return asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._in_flight),
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+        }
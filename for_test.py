@@ -26,5 +26,5 @@ def run_async(coro: Coroutine) -> None:
     loop.run_until_complete(coro)
 
 
-
-run_async(main())
+if __name__ == "__main__":
+    run_async(main())
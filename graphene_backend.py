@@ -7,10 +7,11 @@
 @Desc    :   修补graphene，使得n+1问题能够被解决
 """
 import asyncio
+import hashlib
 import traceback
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
-from graphql import MiddlewareManager, GraphQLList
+from graphql import MiddlewareManager, GraphQLList, GraphQLError
 from graphql.backend.core import GraphQLCoreBackend, validate, ExecutionResult
 from functools import partial
 
@@ -27,8 +28,14 @@ from graphql.language import ast
 from graphql.backend.base import GraphQLDocument
 import warnings
 
+import graphene_executor
+import model_version
+import tracing
+from cache import LRUCache, ResultCache, SingleFlight, MISSING, freeze
+from query_cost import QueryCost, estimate_cost, DEFAULT_LIST_SIZE
+
 # Necessary for static type checking
-from typing import Any, Optional, Union, Awaitable
+from typing import Any, Optional, Union, Awaitable, Dict
 from graphql.language.ast import Document, OperationDefinition, SelectionSet
 from graphql.type.schema import GraphQLSchema
 
@@ -37,6 +44,18 @@ from graphql.type.schema import GraphQLSchema
 __skip = type("SKIP", (object,), {"__str__": lambda self: "SKIP"})
 SKIP = __skip()
 
+# 进程级的文档缓存，key是(schema, 查询字符串)，value是(语法树, 校验错误)
+# 客户端翻来覆去发的就是那几十个查询，没必要每次都parse和validate
+document_cache = LRUCache(maxsize=512)
+CachedDocument = namedtuple("CachedDocument", ("document_ast", "validation_errors"))
+
+# 进程级的prefetch计划缓存，key是(schema, 语法树, 操作名, 变量)
+# 对于同一个查询，resolve_prefetch算出来的东西总是一样的
+prefetch_plan_cache = LRUCache(maxsize=512)
+
+# 进程级的查询开销缓存，key和prefetch计划的一样
+query_cost_cache = LRUCache(maxsize=512)
+
 
 # 解决N+1问题
 def resolve_prefetch(
@@ -46,8 +65,11 @@ def resolve_prefetch(
         type_=None,
         path=None,
         selection_set=None,  # type: Optional[SelectionSet]
-        action_id=None
+        action_id=None,
+        prefetch=None  # type: Optional[Dict[Any, list]]
 ):
+    if prefetch is None:
+        prefetch = exe_context.context_value["prefetch"]
     if path is None:
         path = []
     if type_ is None:
@@ -74,24 +96,27 @@ def resolve_prefetch(
         except:
             field_def = None
         path_name = SKIP
+        # 没有prefetch_fn的类型（比如分页的包装类型）沿用上一层的action_id
+        new_action_id = action_id
         if prefetch_fn:
             try:
                 # 在 prefetch_fn 中进行类似于select_related prefetch_related等操作
                 # 告诉orm应该加载关系
                 # 返回的东西会被拼凑到path里面，如果返回SKIP，那么不会拼路径，如果不返回，那么字段名将拼凑到路径中
-                new_action_id = action_id
 
                 def set_action_id(x):
                     nonlocal new_action_id
                     new_action_id = x
 
                 def add_prefetch_info(x):
-                    exe_context.context_value["prefetch"][action_id].append(x)
+                    prefetch[action_id].append(x)
 
+                # 字段的参数也交给prefetch_fn，比如关系上的first和过滤条件
+                prefetch_args = exe_context.get_argument_values(field_def, field_ast) if field_def else {}
                 path_name = prefetch_fn(action_id=action_id, prefetch_name=field_name,
                                         prefetch_field_def=field_def, path=path,
                                         add_prefetch_info=add_prefetch_info,
-                                        set_action_id=set_action_id)
+                                        set_action_id=set_action_id, prefetch_args=prefetch_args)
             except:
                 traceback.print_exc()
         if field_def and field_ast.selection_set:
@@ -100,7 +125,112 @@ def resolve_prefetch(
             else:
                 new_path = path + [path_name]
             resolve_prefetch(exe_context, operation, root_type,
-                             field_def.type, new_path, field_ast.selection_set, new_action_id)
+                             field_def.type, new_path, field_ast.selection_set, new_action_id, prefetch)
+
+
+def get_prefetch_plan(
+        exe_context,  # type: ExecutionContext
+        document_ast,  # type: Document
+        operation_name=None,  # type: Optional[str]
+        cache=prefetch_plan_cache,  # type: Optional[LRUCache]
+):
+    # type: (...) -> Dict[Any, list]
+    """
+    取得prefetch计划，同一个文档、操作名和变量只遍历一次语法树
+    返回的字典不能修改，它是被缓存共享的
+    """
+    key = (exe_context.schema, document_ast, operation_name, freeze(exe_context.variable_values))
+    plan = MISSING if cache is None else cache.get(key)
+    if plan is MISSING:
+        plan = defaultdict(list)
+        resolve_prefetch(exe_context, exe_context.operation, prefetch=plan)
+        plan = dict(plan)
+        if cache is not None:
+            cache.set(key, plan)
+    return plan
+
+
+def get_query_cost(
+        exe_context,  # type: ExecutionContext
+        document_ast,  # type: Document
+        operation_name=None,  # type: Optional[str]
+        default_list_size=DEFAULT_LIST_SIZE,  # type: int
+        cache=query_cost_cache,  # type: Optional[LRUCache]
+):
+    # type: (...) -> QueryCost
+    key = (exe_context.schema, document_ast, operation_name, freeze(exe_context.variable_values), default_list_size)
+    cost = MISSING if cache is None else cache.get(key)
+    if cost is MISSING:
+        cost = estimate_cost(exe_context, default_list_size=default_list_size)
+        if cache is not None:
+            cache.set(key, cost)
+    return cost
+
+
+def get_etag(
+        backend,  # type: MyGraphQLBackend
+        schema,  # type: GraphQLSchema
+        document_string,  # type: str
+        variable_values=None,  # type: Optional[Dict]
+        operation_name=None,  # type: Optional[str]
+):
+    # type: (...) -> Optional[str]
+    """
+    不执行查询，用prefetch计划找出查询会读的表，根据这些表的数据版本号算出弱ETag，见 model_version
+    数据没有变化的时候ETag不变；不是查询、有错误或者找不到读了哪些表的时候返回None
+    文档和prefetch计划都走缓存，执行查询的时候可以直接用
+    """
+    try:
+        document_ast, validation_errors = backend.parse_and_validate(schema, document_string)
+        if validation_errors:
+            return None
+        exe_context = ExecutionContext(schema, document_ast, None, {}, variable_values or {},
+                                       operation_name, None, None, False)
+    except GraphQLError:
+        return None
+    if exe_context.operation.operation != "query":
+        return None
+    plan = get_prefetch_plan(exe_context, document_ast, operation_name)
+    tables = model_version.get_read_tables(plan)
+    if not tables:
+        return None
+    versions = tuple((i, model_version.get_version(i)) for i in sorted(tables))
+    key = (model_version.get_epoch(), document_string, operation_name, freeze(exe_context.variable_values), versions)
+    return 'W/"{}"'.format(hashlib.sha1(repr(key).encode()).hexdigest())
+
+
+class StreamingResult(object):
+    """
+    流式执行的查询，data 是 {顶层字段: 值或者future}，见 graphene_executor.start_operation
+    errors 要等所有字段都完成之后才是完整的
+    """
+
+    def __init__(self, data, exe_context, extensions):
+        # type: (Dict, ExecutionContext, Dict) -> None
+        self.data = data
+        self.exe_context = exe_context
+        self.extensions = extensions
+
+    @property
+    def errors(self):
+        return self.exe_context.errors
+
+    def cancel(self):
+        # 客户端断开之后还没输出的字段不用再执行了
+        for value in self.data.values():
+            if isinstance(value, graphene_executor.ListStream):
+                value = value.result
+            if isinstance(value, asyncio.Future):
+                value.cancel()
+
+
+def check_query_cost(cost, max_cost=None, max_depth=None):
+    # type: (QueryCost, Optional[float], Optional[int]) -> Optional[GraphQLError]
+    if max_depth is not None and cost.depth > max_depth:
+        return GraphQLError("查询嵌套了{}层，超过了上限{}层".format(cost.depth, max_depth))
+    if max_cost is not None and cost.cost > max_cost:
+        return GraphQLError("查询的估计开销是{}，超过了上限{}".format(cost.cost, max_cost))
+    return None
 
 
 # 参考 graphql.execution.executor.execute
@@ -115,9 +245,15 @@ def execute(
         executor=None,  # type: Any
         middleware=None,  # type: Optional[Any]
         allow_subscriptions=False,  # type: bool
+        result_cache=None,  # type: Optional[ResultCache]
+        single_flight=None,  # type: Optional[SingleFlight]
+        max_cost=None,  # type: Optional[float]
+        max_depth=None,  # type: Optional[int]
+        default_list_size=DEFAULT_LIST_SIZE,  # type: int
+        stream=False,  # type: bool
         **options  # type: Any
 ):
-    # type: (...) -> Awaitable[ExecutionResult]
+    # type: (...) -> Awaitable[Union[ExecutionResult, StreamingResult]]
 
     if root_value is None and "root" in options:
         warnings.warn(
@@ -165,6 +301,8 @@ def execute(
         context_value = {}
 
     context_value.setdefault("prefetch", defaultdict(list))
+    # 请求内共享的关系加载器，见 loader.get_loader
+    context_value.setdefault("loaders", {})
 
     exe_context = ExecutionContext(
         schema,
@@ -178,14 +316,36 @@ def execute(
         allow_subscriptions,
     )
 
-    def promise_executor(v):
-        # type: (Optional[Any]) -> Union[Dict, Promise[Dict], Observable]
-        return execute_operation(exe_context, exe_context.operation, root_value)
-
-    def on_rejected(error):
-        # type: (Exception) -> None
-        exe_context.errors.append(error)
-        return None
+    # 在执行之前估计开销，超过上限的查询一条sql都不会执行
+    with tracing.phase("cost"):
+        cost = get_query_cost(exe_context, document_ast, operation_name, default_list_size)
+    extensions = {"cost": {"estimated": cost.cost, "depth": cost.depth}}
+    cost_error = check_query_cost(cost, max_cost, max_depth)
+    if cost_error is not None:
+        async def get_rejected_result():
+            return ExecutionResult(errors=[cost_error], invalid=True, extensions=extensions)
+
+        return get_rejected_result()
+
+    is_query = exe_context.operation.operation == 'query'
+    if stream and is_query:
+        # 流式的结果是边执行边输出的，不能缓存也不能和别的请求共用
+        result_cache = single_flight = None
+        # 顶层的列表分段查询，见 BaseCURD.stream_list
+        context_value["stream"] = True
+    result_key = None
+    if (result_cache is not None or single_flight is not None) and is_query:
+        # 只是空白不同的查询共用同一棵语法树，见 MyGraphQLBackend.parse_and_validate
+        result_key = (schema, document_ast, operation_name, freeze(exe_context.variable_values))
+    if result_cache is not None and is_query:
+        cached_result = result_cache.get(result_key)
+        if cached_result is not MISSING:
+            async def get_cached_result():
+                return cached_result
+
+            return get_cached_result()
+    # 表名 -> 执行之前的数据版本号，用来判断结果能不能放进缓存
+    read_versions = {}
 
     def on_resolve(data):
         # type: (Union[None, Dict, Observable]) -> Union[ExecutionResult, Observable]
@@ -193,29 +353,75 @@ def execute(
             return data
 
         if not exe_context.errors:
-            return ExecutionResult(data=data)
-
-        return ExecutionResult(data=data, errors=exe_context.errors)
-
-    def prefetch(data):
-        resolve_prefetch(exe_context, exe_context.operation, root_value)
-        return data
-
-    if exe_context.operation.operation == 'query':
-        promise = Promise.resolve(None).then(prefetch).then(promise_executor).catch(on_rejected).then(on_resolve)
-    else:
-        promise = Promise.resolve(None).then(promise_executor).catch(on_rejected).then(on_resolve)
-
-    # 类似于调用 executor.wait_until_finished
-    # 但是 executor.wait_until_finished 要求当前线程没有loop
-    async def wait_until_finished():
-        while executor.futures:
-            futures = executor.futures
-            executor.futures = []
-            await asyncio.gather(*tuple(futures))
+            return ExecutionResult(data=data, extensions=extensions)
+
+        return ExecutionResult(data=data, errors=exe_context.errors, extensions=extensions)
+
+    def prefetch():
+        plan = get_prefetch_plan(exe_context, document_ast, operation_name)
+        for action_id, infos in plan.items():
+            exe_context.context_value["prefetch"][action_id].extend(infos)
+        if result_cache is not None and result_key is not None:
+            read_versions.update({i: model_version.get_version(i) for i in model_version.get_read_tables(plan)})
+
+    if exe_context.operation.operation == "subscription":
+        # 订阅还是走graphql-core原来的promise执行器
+        def on_rejected(error):
+            # type: (Exception) -> None
+            exe_context.errors.append(error)
+            return None
+
+        promise = Promise.resolve(None).then(
+            lambda v: execute_operation(exe_context, exe_context.operation, root_value)
+        ).catch(on_rejected).then(on_resolve)
+
+        async def wait_subscription():
+            while executor.futures:
+                futures = executor.futures
+                executor.futures = []
+                await asyncio.gather(*tuple(futures), return_exceptions=True)
             return await promise
 
-    return wait_until_finished()
+        return wait_subscription()
+
+    async def start():
+        # 顶层字段开始执行就返回，字段出错的时候和 run 一样记在 exe_context.errors 里
+        try:
+            with tracing.phase("prefetch_plan"):
+                prefetch()
+            data = graphene_executor.start_operation(exe_context, exe_context.operation, root_value)
+        except Exception as e:
+            exe_context.errors.append(e)
+            return on_resolve(None)
+        return StreamingResult(data, exe_context, extensions)
+
+    if stream and is_query:
+        return start()
+
+    # 查询和变更直接在当前事件循环上执行，见 graphene_executor
+    async def run():
+        try:
+            if is_query:
+                with tracing.phase("prefetch_plan"):
+                    prefetch()
+            with tracing.phase("execute"):
+                data = await graphene_executor.execute_operation(exe_context, exe_context.operation, root_value)
+        except Exception as e:
+            exe_context.errors.append(e)
+            data = None
+        result = on_resolve(data)
+        if result_key is not None and read_versions and not result.errors:
+            # 执行期间表被写过的话，结果可能已经旧了，不能缓存
+            if all(model_version.get_version(k) == v for k, v in read_versions.items()):
+                result_cache.set(result_key, result, read_versions.keys())
+        return result
+
+    if single_flight is not None and is_query and exe_context.context_value.get("single_flight", True):
+        # 同时到达的相同查询只执行一次，变更永远不会被合并
+        # 合并的key不包含context和root，共用的那次执行用的是第一个请求的context、加载器和tracer，
+        # 结果和请求有关的时候要在context里放 single_flight=False，见 cache.SingleFlight
+        return single_flight.do(result_key, run)
+    return run()
 
 
 # 和 graphql.execution.executor.execute_and_validate 相同
@@ -228,8 +434,11 @@ def execute_and_validate(
 ):
     # type: (...) -> Awaitable[ExecutionResult]
     do_validation = kwargs.get("validate", True)
+    # 如果文档已经校验过了（来自缓存），那么直接用缓存的结果
+    validation_errors = kwargs.pop("validation_errors", None)
     if do_validation:
-        validation_errors = validate(schema, document_ast)
+        if validation_errors is None:
+            validation_errors = validate(schema, document_ast)
         if validation_errors:
             return Promise.resolve(ExecutionResult(errors=validation_errors, invalid=True))
 
@@ -238,9 +447,50 @@ def execute_and_validate(
 
 class MyGraphQLBackend(GraphQLCoreBackend):
 
-    # 和父类相同，但是execute_and_validate方法被覆盖
+    def __init__(self, executor=None, cache=document_cache, result_cache=None,
+                 max_cost=None, max_depth=None, default_list_size=DEFAULT_LIST_SIZE, single_flight=None):
+        # type: (Any, Optional[LRUCache], Optional[ResultCache], Optional[float], Optional[int], int, Optional[SingleFlight]) -> None
+        super().__init__(executor)
+        # 传入None可以关掉缓存
+        self.cache = cache
+        # 结果缓存默认是关掉的，需要的话传入一个ResultCache
+        self.execute_params["result_cache"] = result_cache
+        # 查询开销的上限，None表示不限制，见 query_cost
+        self.execute_params["max_cost"] = max_cost
+        self.execute_params["max_depth"] = max_depth
+        self.execute_params["default_list_size"] = default_list_size
+        # 合并同时进行的相同查询，默认关掉，需要的话传入一个SingleFlight
+        self.execute_params["single_flight"] = single_flight
+
+    def parse_and_validate(self, schema, document_string):
+        # type: (GraphQLSchema, str) -> CachedDocument
+        key = (schema, document_string)
+        cached = MISSING if self.cache is None else self.cache.get(key)
+        if cached is not MISSING:
+            return cached
+        with tracing.phase("parse"):
+            document_ast = parse(document_string)
+        if self.cache is not None:
+            # 只是空白和格式不同的查询共用同一棵语法树，这样后面的计划缓存和结果缓存也能共用
+            normalized_key = (schema, print_ast(document_ast))
+            cached = self.cache.get(normalized_key)
+            if cached is not MISSING:
+                self.cache.set(key, cached)
+                return cached
+        validation_errors = None
+        if self.execute_params.get("validate", True):
+            with tracing.phase("validate"):
+                validation_errors = validate(schema, document_ast)
+        cached = CachedDocument(document_ast, validation_errors)
+        if self.cache is not None:
+            self.cache.set(key, cached)
+            self.cache.set(normalized_key, cached)
+        return cached
+
+    # 和父类相同，但是execute_and_validate方法被覆盖，并且字符串形式的查询会被缓存
     def document_from_string(self, schema, document_string):
         # type: (GraphQLSchema, Union[Document, str]) -> GraphQLDocument
+        validation_errors = None
         if isinstance(document_string, ast.Document):
             document_ast = document_string
             document_string = print_ast(document_ast)
@@ -248,12 +498,13 @@ class MyGraphQLBackend(GraphQLCoreBackend):
             assert isinstance(
                 document_string, string_types
             ), "The query must be a string"
-            document_ast = parse(document_string)
+            document_ast, validation_errors = self.parse_and_validate(schema, document_string)
         return GraphQLDocument(
             schema=schema,
             document_string=document_string,
             document_ast=document_ast,
             execute=partial(
-                execute_and_validate, schema, document_ast, **self.execute_params
+                execute_and_validate, schema, document_ast,
+                validation_errors=validation_errors, **self.execute_params
             ),
         )
@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   graphene_executor.py
+@Time    :   2021/3/6 14:20
+@Desc    :   不依赖promise的执行器，直接在当前的事件循环上await resolver
+"""
+import asyncio
+import logging
+import sys
+from collections.abc import Iterable
+
+from graphql import GraphQLError
+from graphql.error import GraphQLLocatedError
+from graphql.execution.base import ResolveInfo, default_resolve_fn
+from graphql.execution.utils import ExecutionContext, get_operation_root_type, collect_fields, get_field_def
+from graphql.pyutils.default_ordered_dict import DefaultOrderedDict
+from graphql.pyutils.ordereddict import OrderedDict
+from graphql.type import (
+    GraphQLEnumType,
+    GraphQLInterfaceType,
+    GraphQLList,
+    GraphQLNonNull,
+    GraphQLObjectType,
+    GraphQLScalarType,
+    GraphQLUnionType,
+)
+from graphql.utils.undefined import Undefined
+from promise import is_thenable
+from six import string_types
+
+from typing import Any, Optional, Union, Dict, List, Awaitable, AsyncIterator
+
+logger = logging.getLogger(__name__)
+
+# 整体的思路和 graphql.execution.executor 一样，区别在于：
+# 1. 同步的结果直接返回，不包装成Promise，只有真正需要等待的地方才是协程
+# 2. 兄弟字段（以及列表的各项）用 asyncio.gather 一起等待
+# 3. 返回之前所有启动的协程都已经结束，不会有漏掉的future
+
+
+async def gather_all(awaitables: List[Awaitable]) -> List[Any]:
+    if len(awaitables) == 1:
+        return [await awaitables[0]]
+    # 即使有一个失败了也要等其他的都结束，再把第一个异常抛出去
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for i in results:
+        if isinstance(i, BaseException):
+            raise i
+    return results
+
+
+async def gather_into(container, keys):
+    values = await gather_all([container[k] for k in keys])
+    for k, v in zip(keys, values):
+        container[k] = v
+    return container
+
+
+async def execute_operation(
+        exe_context: ExecutionContext,
+        operation: Any,
+        root_value: Any,
+) -> Optional[Dict]:
+    type_ = get_operation_root_type(exe_context.schema, operation)
+    fields = collect_fields(
+        exe_context, type_, operation.selection_set, DefaultOrderedDict(list), set()
+    )
+    if operation.operation == "mutation":
+        return await execute_fields_serially(exe_context, type_, root_value, [], fields)
+
+    assert operation.operation == "query", "订阅请使用 graphql.execution.executor"
+    result = execute_fields(exe_context, type_, root_value, fields, [], None)
+    if is_thenable(result):
+        result = await result
+    return result
+
+
+class ListStream(object):
+    """
+    流式执行时顶层的列表字段，resolver的结果出来之后一批一批地完成各项，见 start_operation
+    每一批里的各项一起等待，关系加载器仍然可以把同一批的请求合并
+    各项的错误不能再传递到整个列表了，出错的项是null
+    """
+
+    def __init__(self, exe_context: ExecutionContext, return_type: Union[GraphQLList, GraphQLNonNull],
+                 field_asts: List[Any], info: ResolveInfo, path: List[Union[int, str]], result: Any) -> None:
+        self.exe_context = exe_context
+        self.return_type = return_type
+        self.field_asts = field_asts
+        self.info = info
+        self.path = path
+        self.result = result
+
+    async def resolve(self) -> Optional[Iterable]:
+        # resolver的结果，出错或者是null的时候返回None
+        result = self.result
+        try:
+            if is_thenable(result):
+                result = await result
+            if isinstance(result, Exception):
+                raise result
+        except Exception as e:
+            self.exe_context.report_error(
+                GraphQLLocatedError(self.field_asts, original_error=e, path=self.path), sys.exc_info()[2]
+            )
+            return None
+        if result is None and isinstance(self.return_type, GraphQLNonNull):
+            self.exe_context.report_error(GraphQLError(
+                "Cannot return null for non-nullable field {}.{}.".format(self.info.parent_type, self.info.field_name),
+                self.field_asts,
+                path=self.path,
+            ))
+        return result
+
+    async def iter_items(self, items: Union[Iterable, AsyncIterator[List]], batch_size: int):
+        # items 也可以是一段一段给出列表的异步迭代器，见 graphene_model_base.BaseCURD.stream_list
+        return_type = self.return_type
+        if isinstance(return_type, GraphQLNonNull):
+            return_type = return_type.of_type
+        item_type = return_type.of_type
+        if not isinstance(items, AsyncIterator):
+            items = iter_chunks(items, batch_size)
+        index = 0
+        try:
+            async for chunk in items:
+                for start in range(0, len(chunk), batch_size):
+                    batch = list(enumerate(chunk[start:start + batch_size], index + start))
+                    for i in await self.complete_batch(item_type, batch):
+                        yield i
+                index += len(chunk)
+        finally:
+            if hasattr(items, "aclose"):
+                await items.aclose()
+
+    async def complete_batch(self, item_type, batch):
+        completed = []
+        pending = []
+        for index, item in batch:
+            if isinstance(item_type, GraphQLNonNull):
+                # 非空的项出错也只能是null，见类的说明
+                value = complete_value_catching_error(
+                    self.exe_context, item_type.of_type, self.field_asts, self.info, self.path + [index], item
+                )
+            else:
+                value = complete_value_catching_error(
+                    self.exe_context, item_type, self.field_asts, self.info, self.path + [index], item
+                )
+            if is_thenable(value):
+                pending.append(len(completed))
+            completed.append(value)
+        if pending:
+            await gather_into(completed, pending)
+        return completed
+
+
+async def iter_chunks(items: Iterable, size: int) -> AsyncIterator[List]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def start_operation(
+        exe_context: ExecutionContext,
+        operation: Any,
+        root_value: Any,
+) -> Dict:
+    """
+    和 execute_operation 一样开始执行查询，但是不等待顶层字段
+    返回 {字段: 值、future或者ListStream}，所有字段的resolver已经同时在执行，
+    调用者按顺序等待每个字段就可以边执行边输出
+    """
+    assert operation.operation == "query", "只有查询可以流式执行"
+    type_ = get_operation_root_type(exe_context.schema, operation)
+    fields = collect_fields(
+        exe_context, type_, operation.selection_set, DefaultOrderedDict(list), set()
+    )
+    results = OrderedDict()
+    for response_name, field_asts in fields.items():
+        result = start_field(exe_context, type_, root_value, field_asts, [response_name])
+        if result is Undefined:
+            continue
+        if is_thenable(result):
+            result = asyncio.ensure_future(result)
+        results[response_name] = result
+    return results
+
+
+def start_field(
+        exe_context: ExecutionContext,
+        parent_type: GraphQLObjectType,
+        source: Any,
+        field_asts: List[Any],
+        field_path: List[Union[int, str]],
+) -> Any:
+    # 和 resolve_field 一样，只是列表字段返回 ListStream
+    field_ast = field_asts[0]
+    field_def = get_field_def(exe_context.schema, parent_type, field_ast.name.value)
+    if not field_def:
+        return Undefined
+    return_type = field_def.type
+    list_type = return_type.of_type if isinstance(return_type, GraphQLNonNull) else return_type
+    if not isinstance(list_type, GraphQLList):
+        return resolve_field(exe_context, parent_type, source, field_asts, None, field_path)
+
+    resolve_fn = field_def.resolver or default_resolve_fn
+    resolve_fn_middleware = exe_context.get_field_resolver(resolve_fn)
+    args = exe_context.get_argument_values(field_def, field_ast)
+    info = ResolveInfo(
+        field_ast.name.value,
+        field_asts,
+        return_type,
+        parent_type,
+        schema=exe_context.schema,
+        fragments=exe_context.fragments,
+        root_value=exe_context.root_value,
+        operation=exe_context.operation,
+        variable_values=exe_context.variable_values,
+        context=exe_context.context_value,
+        path=field_path,
+    )
+    try:
+        result = resolve_fn_middleware(source, info, **args)
+    except Exception as e:
+        result = e
+    if is_thenable(result):
+        # 马上开始执行，和别的顶层字段同时进行
+        result = asyncio.ensure_future(result)
+    return ListStream(exe_context, return_type, field_asts, info, field_path, result)
+
+
+async def execute_fields_serially(
+        exe_context: ExecutionContext,
+        parent_type: GraphQLObjectType,
+        source_value: Any,
+        path: List,
+        fields: DefaultOrderedDict,
+) -> Dict:
+    # mutation的各个字段必须按顺序执行
+    results = OrderedDict()
+    for response_name, field_asts in fields.items():
+        result = resolve_field(exe_context, parent_type, source_value, field_asts, None,
+                               path + [response_name])
+        if result is Undefined:
+            continue
+        if is_thenable(result):
+            result = await result
+        results[response_name] = result
+    return results
+
+
+def execute_fields(
+        exe_context: ExecutionContext,
+        parent_type: GraphQLObjectType,
+        source_value: Any,
+        fields: DefaultOrderedDict,
+        path: List[Union[int, str]],
+        info: Optional[ResolveInfo],
+) -> Union[Dict, Awaitable[Dict]]:
+    final_results = OrderedDict()
+    pending = []
+    for response_name, field_asts in fields.items():
+        result = resolve_field(exe_context, parent_type, source_value, field_asts, info,
+                               path + [response_name])
+        if result is Undefined:
+            continue
+        final_results[response_name] = result
+        if is_thenable(result):
+            pending.append(response_name)
+
+    if not pending:
+        return final_results
+    return gather_into(final_results, pending)
+
+
+def resolve_field(
+        exe_context: ExecutionContext,
+        parent_type: GraphQLObjectType,
+        source: Any,
+        field_asts: List[Any],
+        parent_info: Optional[ResolveInfo],
+        field_path: List[Union[int, str]],
+) -> Any:
+    field_ast = field_asts[0]
+    field_name = field_ast.name.value
+
+    field_def = get_field_def(exe_context.schema, parent_type, field_name)
+    if not field_def:
+        return Undefined
+
+    return_type = field_def.type
+    resolve_fn = field_def.resolver or default_resolve_fn
+    resolve_fn_middleware = exe_context.get_field_resolver(resolve_fn)
+    args = exe_context.get_argument_values(field_def, field_ast)
+    info = ResolveInfo(
+        field_name,
+        field_asts,
+        return_type,
+        parent_type,
+        schema=exe_context.schema,
+        fragments=exe_context.fragments,
+        root_value=exe_context.root_value,
+        operation=exe_context.operation,
+        variable_values=exe_context.variable_values,
+        context=exe_context.context_value,
+        path=field_path,
+    )
+
+    try:
+        # 直接调用，是协程的话交给 complete_value 去等待
+        result = resolve_fn_middleware(source, info, **args)
+    except Exception as e:
+        logger.exception(
+            "An error occurred while resolving field {}.{}".format(
+                info.parent_type.name, info.field_name
+            )
+        )
+        e.stack = sys.exc_info()[2]  # type: ignore
+        result = e
+
+    return complete_value_catching_error(
+        exe_context, return_type, field_asts, info, field_path, result
+    )
+
+
+async def catch_error(exe_context: ExecutionContext, completed: Awaitable) -> Any:
+    try:
+        return await completed
+    except Exception as e:
+        exe_context.report_error(e, sys.exc_info()[2])
+        return None
+
+
+def complete_value_catching_error(
+        exe_context: ExecutionContext,
+        return_type: Any,
+        field_asts: List[Any],
+        info: ResolveInfo,
+        path: List[Union[int, str]],
+        result: Any,
+) -> Any:
+    # 非空的字段出错的时候要让错误传递到上一层
+    if isinstance(return_type, GraphQLNonNull):
+        return complete_value(exe_context, return_type, field_asts, info, path, result)
+
+    try:
+        completed = complete_value(exe_context, return_type, field_asts, info, path, result)
+    except Exception as e:
+        exe_context.report_error(e, sys.exc_info()[2])
+        return None
+    if is_thenable(completed):
+        return catch_error(exe_context, completed)
+    return completed
+
+
+async def complete_awaitable_value(
+        exe_context: ExecutionContext,
+        return_type: Any,
+        field_asts: List[Any],
+        info: ResolveInfo,
+        path: List[Union[int, str]],
+        result: Awaitable,
+) -> Any:
+    try:
+        resolved = await result
+    except Exception as e:
+        raise GraphQLLocatedError(field_asts, original_error=e, path=path)
+    completed = complete_value(exe_context, return_type, field_asts, info, path, resolved)
+    if is_thenable(completed):
+        completed = await completed
+    return completed
+
+
+def complete_value(
+        exe_context: ExecutionContext,
+        return_type: Any,
+        field_asts: List[Any],
+        info: ResolveInfo,
+        path: List[Union[int, str]],
+        result: Any,
+) -> Any:
+    # 注意只有协程、future和promise才需要等待
+    # tortoise的模型和查询集虽然也是Awaitable，但是它们是resolver的结果，不能再await
+    if is_thenable(result):
+        return complete_awaitable_value(exe_context, return_type, field_asts, info, path, result)
+
+    if isinstance(result, Exception):
+        raise GraphQLLocatedError(field_asts, original_error=result, path=path)
+
+    if isinstance(return_type, GraphQLNonNull):
+        return complete_nonnull_value(exe_context, return_type, field_asts, info, path, result)
+
+    if result is None:
+        return None
+
+    if isinstance(return_type, GraphQLList):
+        return complete_list_value(exe_context, return_type, field_asts, info, path, result)
+
+    if isinstance(return_type, (GraphQLScalarType, GraphQLEnumType)):
+        return complete_leaf_value(return_type, path, result)
+
+    if isinstance(return_type, (GraphQLInterfaceType, GraphQLUnionType)):
+        return complete_abstract_value(exe_context, return_type, field_asts, info, path, result)
+
+    if isinstance(return_type, GraphQLObjectType):
+        return complete_object_value(exe_context, return_type, field_asts, info, path, result)
+
+    assert False, u'Cannot complete value of unexpected type "{}".'.format(return_type)
+
+
+def complete_list_value(
+        exe_context: ExecutionContext,
+        return_type: GraphQLList,
+        field_asts: List[Any],
+        info: ResolveInfo,
+        path: List[Union[int, str]],
+        result: Any,
+) -> Union[List[Any], Awaitable[List[Any]]]:
+    assert isinstance(result, Iterable), (
+            "User Error: expected iterable, but did not find one " + "for field {}.{}."
+    ).format(info.parent_type, info.field_name)
+
+    item_type = return_type.of_type
+    completed_results = []
+    pending = []
+    for index, item in enumerate(result):
+        completed_item = complete_value_catching_error(
+            exe_context, item_type, field_asts, info, path + [index], item
+        )
+        if is_thenable(completed_item):
+            pending.append(index)
+        completed_results.append(completed_item)
+
+    if not pending:
+        return completed_results
+    return gather_into(completed_results, pending)
+
+
+def complete_leaf_value(
+        return_type: Union[GraphQLEnumType, GraphQLScalarType],
+        path: List[Union[int, str]],
+        result: Any,
+) -> Union[int, str, float, bool]:
+    serialized_result = return_type.serialize(result)
+    if serialized_result is None:
+        raise GraphQLError(
+            ('Expected a value of type "{}" but ' + "received: {}").format(return_type, result),
+            path=path,
+        )
+    return serialized_result
+
+
+def complete_abstract_value(
+        exe_context: ExecutionContext,
+        return_type: Union[GraphQLInterfaceType, GraphQLUnionType],
+        field_asts: List[Any],
+        info: ResolveInfo,
+        path: List[Union[int, str]],
+        result: Any,
+) -> Any:
+    if return_type.resolve_type:
+        runtime_type = return_type.resolve_type(result, info)
+    else:
+        runtime_type = None
+        for type_ in info.schema.get_possible_types(return_type):
+            if callable(type_.is_type_of) and type_.is_type_of(result, info):
+                runtime_type = type_
+                break
+
+    if isinstance(runtime_type, string_types):
+        runtime_type = info.schema.get_type(runtime_type)
+
+    if not isinstance(runtime_type, GraphQLObjectType):
+        raise GraphQLError(
+            (
+                    "Abstract type {} must resolve to an Object type at runtime "
+                    + 'for field {}.{} with value "{}", received "{}".'
+            ).format(return_type, info.parent_type, info.field_name, result, runtime_type),
+            field_asts,
+        )
+
+    if not exe_context.schema.is_possible_type(return_type, runtime_type):
+        raise GraphQLError(
+            u'Runtime Object type "{}" is not a possible type for "{}".'.format(runtime_type, return_type),
+            field_asts,
+        )
+
+    return complete_object_value(exe_context, runtime_type, field_asts, info, path, result)
+
+
+def complete_object_value(
+        exe_context: ExecutionContext,
+        return_type: GraphQLObjectType,
+        field_asts: List[Any],
+        info: ResolveInfo,
+        path: List[Union[int, str]],
+        result: Any,
+) -> Union[Dict, Awaitable[Dict]]:
+    if return_type.is_type_of and not return_type.is_type_of(result, info):
+        raise GraphQLError(
+            u'Expected value of type "{}" but got: {}.'.format(return_type, type(result).__name__),
+            field_asts,
+        )
+
+    subfield_asts = exe_context.get_sub_fields(return_type, field_asts)
+    return execute_fields(exe_context, return_type, result, subfield_asts, path, info)
+
+
+def complete_nonnull_value(
+        exe_context: ExecutionContext,
+        return_type: GraphQLNonNull,
+        field_asts: List[Any],
+        info: ResolveInfo,
+        path: List[Union[int, str]],
+        result: Any,
+) -> Any:
+    completed = complete_value(exe_context, return_type.of_type, field_asts, info, path, result)
+    if is_thenable(completed):
+        return check_nonnull(completed, info, field_asts, path)
+    if completed is None:
+        raise GraphQLError(
+            "Cannot return null for non-nullable field {}.{}.".format(info.parent_type, info.field_name),
+            field_asts,
+            path=path,
+        )
+    return completed
+
+
+async def check_nonnull(completed, info, field_asts, path):
+    completed = await completed
+    if completed is None:
+        raise GraphQLError(
+            "Cannot return null for non-nullable field {}.{}.".format(info.parent_type, info.field_name),
+            field_asts,
+            path=path,
+        )
+    return completed
@@ -6,27 +6,255 @@
 @Time    :   2021/2/23 10:28
 @Desc    :
 """
+import json
 import traceback
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from copy import copy
 from functools import partial
 from typing import Type, Awaitable, AsyncIterable, Callable, List, Dict
 
-from graphene import ObjectType, Int, String, Field, List as GqlList
+from graphene import ObjectType, InputObjectType, Int, String, Boolean, Field, NonNull, Scalar, List as GqlList
 from graphene.types.base import BaseType
 from graphene.types.mountedtype import MountedType
 from graphene.types.structures import Structure
 from graphene.types.unmountedtype import UnmountedType
 from graphene.utils.subclass_with_meta import SubclassWithMeta_Meta
+from promise import is_thenable
 from tortoise import Model
+from tortoise.exceptions import DoesNotExist
+from tortoise.fields.relational import NoneAwaitable
+from tortoise.query_utils import Prefetch, Q
 from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
 
 from graphene_backend import SKIP
+from loader import get_loader, get_aggregate_loader, get_slice_loader, get_slice_args, fetch_relation_slice, \
+    SLICE_LIMIT_ARG, SLICE_ORDER_ARG
+from cache import LRUCache, MISSING, freeze
+from model_version import get_table, get_version, watch_model, bump_on, ReadInfo
+from bulk import bulk_insert, bulk_update, bulk_delete, get_written_tables
+from rows import Row, fetch_row_list, get_model_type
+from identity_map import IdentityMap, get_identity_map
 
 from collections import namedtuple
 from uuid import uuid4
 
+# 所有BaseCURD共用的count缓存，过期时间由各自的count_cache_ttl决定
+count_cache = LRUCache(maxsize=1024)
+
 PrefetchPath = namedtuple("PrefetchPath", ("related_name", "orm_type"))
 PrefetchInfo = namedtuple("PrefetchInfo", ("prefetch_path", "orm_type"))
+# prefetch_path 下面的对象需要加载 field_name 这一列，field_name 为 None 表示要加载整行
+SelectInfo = namedtuple("SelectInfo", ("prefetch_path", "field_name", "orm_type"))
+# prefetch_path 这个关系带了first、orderBy或者过滤参数，需要单独做一次切片查询，args 见 loader.get_slice_args
+# args 为None表示参数不合法，这个关系和它下面的都不预先加载
+SliceInfo = namedtuple("SliceInfo", ("prefetch_path", "args", "orm_type"))
+# 关系上的聚合，function是count、min或者max，count的column为None
+AggregateInfo = namedtuple("AggregateInfo", ("relation", "function", "column"))
+
+
+def build_prefetch_tree(prefetch_paths):
+    """
+    把 a__b__c 这样的路径合并成一棵树 {"a": {"b": {"c": {}}}}
+    """
+    tree = {}
+    for prefetch_path in prefetch_paths:
+        node = tree
+        for name in prefetch_path.split("__"):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def flatten_prefetch_tree(tree, prefix=""):
+    # 只输出叶子，tortoise会自动加载路径上的中间节点
+    ret = []
+    for name, sub_tree in tree.items():
+        path = prefix + name
+        if sub_tree:
+            ret.extend(flatten_prefetch_tree(sub_tree, path + "__"))
+        else:
+            ret.append(path)
+    return ret
+
+
+def is_forward_only(model: Type[Model], tree) -> bool:
+    meta_info = model._meta
+    for name, sub_tree in tree.items():
+        if name not in meta_info.fk_fields and name not in meta_info.o2o_fields:
+            return False
+        if not is_forward_only(meta_info.fields_map[name].related_model, sub_tree):
+            return False
+    return True
+
+
+def build_select_columns(select_infos):
+    """
+    把 SelectInfo 整理成 {路径: 列名集合}，集合里有None表示要整行
+    """
+    columns = {}
+    for i in select_infos:
+        columns.setdefault(i.prefetch_path, set()).add(i.field_name)
+    return columns
+
+
+def get_only_fields(model: Type[Model], tree, selected, extra_fields=()):
+    """
+    计算某一层实际要select的列：被查询的列、主键，以及加载关系要用到的键
+    返回None表示不做投影
+    """
+    if selected is None or None in selected:
+        return None
+    meta_info = model._meta
+    fields = set(selected) | set(extra_fields) | {meta_info.pk_attr}
+    for name in tree:
+        field = meta_info.fields_map[name]
+        if name in meta_info.fk_fields or name in meta_info.o2o_fields:
+            fields.add(field.source_field)
+        elif name in meta_info.backward_fk_fields or name in meta_info.backward_o2o_fields:
+            fields.add(field.to_field_instance.model_field_name)
+    return fields
+
+
+def apply_prefetch_tree(query_set: QuerySet, tree, allow_join=True,
+                        columns=None, prefix="", extra_fields=()) -> QuerySet:
+    """
+    根据prefetch树规划查询：
+    外键和一对一这种正向的关系，如果下面也全是正向的关系，那么用select_related直接join
+    反向外键和多对多用prefetch_related，每一层一条 WHERE ... IN (...) 查询
+    这样sql语句的数量只和查询的深度有关，和结果的行数无关
+    如果给了columns，那么每一层都只select被查询的列
+    """
+    meta_info = query_set.model._meta
+    tree = {k: v for k, v in tree.items() if k in meta_info.fetch_fields}
+    if columns is not None and allow_join:
+        only_fields = get_only_fields(query_set.model, tree, columns.get(prefix.rstrip("_"), set()),
+                                      extra_fields)
+        if only_fields is not None:
+            query_set = query_set.only(*only_fields)
+    if not tree:
+        return query_set
+    if not allow_join:
+        # tortoise加载多对多的时候会忽略子查询集上的select_related和Prefetch对象
+        # 所以只能退化成字符串路径，仍然是每一层一条查询
+        return query_set.prefetch_related(*flatten_prefetch_tree(tree))
+
+    select_related = []
+    prefetch_related = []
+    for name, sub_tree in tree.items():
+        related_model = meta_info.fields_map[name].related_model
+        if (name in meta_info.fk_fields or name in meta_info.o2o_fields) \
+                and is_forward_only(related_model, sub_tree):
+            select_related.extend(flatten_prefetch_tree({name: sub_tree}))
+        else:
+            field = meta_info.fields_map[name]
+            if name in meta_info.backward_fk_fields or name in meta_info.backward_o2o_fields:
+                # 反向关系要靠子对象上的外键分组
+                sub_extra_fields = (field.relation_field,)
+            elif name in meta_info.m2m_fields:
+                sub_extra_fields = ()
+            else:
+                sub_extra_fields = (field.to_field,)
+            sub_query_set = apply_prefetch_tree(related_model.all(), sub_tree,
+                                                allow_join=name not in meta_info.m2m_fields,
+                                                columns=columns, prefix=f"{prefix}{name}__",
+                                                extra_fields=sub_extra_fields)
+            prefetch_related.append(Prefetch(name, sub_query_set))
+    if select_related:
+        query_set = query_set.select_related(*select_related)
+    if prefetch_related:
+        query_set = query_set.prefetch_related(*prefetch_related)
+    return query_set
+
+
+def is_under_slice(prefetch_path, sliced_paths, prefetched_paths, start=0) -> bool:
+    """
+    路径经过了切片的关系（并且这个关系没有以不带参数的形式被查询），就只能由切片查询来加载
+    交给orm的话会把整个关系加载出来
+    start 是已经处理过的层数，只检查更深的切片
+    """
+    names = prefetch_path.split("__")
+    for i in range(start + 1, len(names) + 1):
+        path = "__".join(names[:i])
+        if path in sliced_paths and path not in prefetched_paths:
+            return True
+    return False
+
+
+def collect_instances(instances, names) -> list:
+    """
+    沿着路径取得已经加载的对象，经过切片关系的时候取这个关系所有参数下的切片
+    """
+    for name in names:
+        next_instances = {}
+        for instance in instances:
+            meta_info = instance._meta
+            values = []
+            for (relation, _), value in getattr(instance, "_relation_slices", {}).items():
+                if relation == name:
+                    values.extend(value)
+            if name in meta_info.backward_fk_fields or name in meta_info.m2m_fields:
+                relation = getattr(instance, name)
+                if relation._fetched:
+                    values.extend(relation)
+            else:
+                value = getattr(instance, name)
+                if isinstance(value, Model):
+                    values.append(value)
+            for i in values:
+                next_instances[id(i)] = i
+        instances = list(next_instances.values())
+    return instances
+
+
+async def prefetch_relation_slices(model: Type[Model], instances: List[Model], prefetch):
+    """
+    在查出根对象之后，按深度从浅到深，每个切片的关系发一次窗口查询，见 loader.fetch_relation_slice
+    切片下面的关系和投影在切片查询上规划，结果按参数存在父对象的 _relation_slices 里
+    """
+    if not prefetch or not instances:
+        return
+    prefetch = [i for i in prefetch if i.orm_type is model]
+    slice_infos = sorted({i for i in prefetch if isinstance(i, SliceInfo)},
+                         key=lambda i: i.prefetch_path.count("__"))
+    if not slice_infos:
+        return
+    sliced_paths = {i.prefetch_path for i in slice_infos}
+    prefetched_paths = {i.prefetch_path for i in prefetch if isinstance(i, PrefetchInfo)}
+    columns = build_select_columns(i for i in prefetch if isinstance(i, SelectInfo))
+    for slice_info in slice_infos:
+        if slice_info.args is None:
+            continue
+        *owner, relation = slice_info.prefetch_path.split("__")
+        parents = collect_instances(instances, owner)
+        if not parents:
+            continue
+        parent_model = type(parents[0])
+        prefix = slice_info.prefetch_path + "__"
+        sub_tree = build_prefetch_tree(
+            i[len(prefix):] for i in prefetched_paths
+            if i.startswith(prefix) and not is_under_slice(i, sliced_paths, prefetched_paths, len(owner) + 1)
+        )
+        related_model = parent_model._meta.fields_map[relation].related_model
+        query_set = apply_prefetch_tree(related_model.all(), sub_tree, columns=columns, prefix=prefix)
+        slices = await fetch_relation_slice(parent_model, relation, parents, slice_info.args, query_set)
+        for parent in parents:
+            if not hasattr(parent, "_relation_slices"):
+                parent._relation_slices = {}
+            parent._relation_slices[(relation, slice_info.args)] = slices.get(parent.pk, [])
+
+
+def build_arguments(filter_args: Dict[str, dict]):
+    """
+    把 BaseCURD.filter_args 格式的定义转换成graphene的参数
+    """
+    ret = {}
+    for k, v in filter_args.items():
+        args = {}
+        if "default_value" in v:
+            args["default_value"] = v["default_value"]
+        ret[k] = v.get("type", String)(**args)
+    return ret
+
 
 def to_underline(name):
     assert name
@@ -44,6 +272,138 @@ def to_camel(name: str):
     return s[0].lower()+s[1:]
 
 
+def get_attr_or_item(parent, item):
+    value = None
+    try:
+        # 如果是类似字典的，那么使用in操作
+        if item in parent:
+            value = parent[item]
+    except TypeError:
+        # 如果使用in关键字发生异常，那么尝试取属性
+        try:
+            if hasattr(parent, item):
+                value = getattr(parent, item)
+        except:
+            traceback.print_exc()
+    except:
+        traceback.print_exc()
+    return value
+
+
+async def await_relation(value):
+    if isinstance(value, AsyncIterable):
+        return [i async for i in value]
+    return await value
+
+
+def resolve_slice(parent: Model, info, item, slice_args):
+    # 已经由 prefetch_relation_slices 加载的话直接取，否则交给加载器合并成一次切片查询
+    slices = getattr(parent, "_relation_slices", None)
+    if slices is not None and (item, slice_args) in slices:
+        return slices[(item, slice_args)]
+    context = info.context if isinstance(info.context, dict) else {}
+    return get_slice_loader(context, get_model_type(parent), item, slice_args).load(parent)
+
+
+def load_relation(parent: Model, info, item, value):
+    # 没有被prefetch，交给加载器在这一轮事件循环里合并查询
+    if isinstance(info.context, dict):
+        return get_loader(info.context, type(parent), item).load(parent)
+    return await_relation(value)
+
+
+class FieldResolver:
+    """
+    自动生成的resolve
+    graphene构造schema的时候orm还没有初始化，反向关系之类的信息还不全
+    所以第一次遇到某个类型的parent的时候，才按照字段的种类生成专门的取值函数，之后直接调用
+    列是同步取属性，不会变成协程；关系没有加载的时候返回加载器的future
+    """
+    __slots__ = ("item", "resolvers")
+
+    def __init__(self, item: str):
+        self.item = item
+        # parent的类型 -> 取值函数
+        self.resolvers: Dict[type, Callable] = {}
+
+    def __call__(self, parent, info, **kwargs):
+        try:
+            resolver = self.resolvers[type(parent)]
+        except KeyError:
+            resolver = self.resolvers[type(parent)] = self.compile(type(parent))
+        return resolver(parent, info, **kwargs)
+
+    def compile(self, parent_type: type) -> Callable:
+        item = self.item
+        if issubclass(parent_type, Row):
+            # 快速路径的行对象，查询到的列和关系都已经是属性，见 rows
+            def resolve_row(parent, info, **kwargs):
+                return getattr(parent, item, None)
+
+            return resolve_row
+
+        if not issubclass(parent_type, Model) or item not in parent_type._meta.fields:
+            def resolve_other(parent, info, **kwargs):
+                return get_attr_or_item(parent, item)
+
+            return resolve_other
+
+        meta_info = parent_type._meta
+        if item in meta_info.fields_db_projection:
+            # 这种字段和数据库字段对应，可以直接取得值
+            def resolve_column(parent, info, **kwargs):
+                return getattr(parent, item)
+
+            return resolve_column
+
+        if item in meta_info.backward_fk_fields or item in meta_info.m2m_fields:
+            related_model = meta_info.fields_map[item].related_model
+
+            def resolve_many(parent, info, **kwargs):
+                if kwargs:
+                    # 参数不合法的话在这个字段上报错，见 GrapheneModelObject.prefetch_fn
+                    slice_args = get_slice_args(kwargs, related_model)
+                    if slice_args:
+                        return resolve_slice(parent, info, item, slice_args)
+                # 反向外键和多对多得到的是关系对象，它本身也是Awaitable，但是await它总会重新查询
+                value = getattr(parent, item)
+                if value._fetched:
+                    return list(value)
+                return load_relation(parent, info, item, value)
+
+            return resolve_many
+
+        assert item in meta_info.fetch_fields, "不该执行到这里"
+
+        def resolve_one(parent, info, **kwargs):
+            # 一对一或者外键，已经加载的话得到的是模型，否则是查询集
+            value = getattr(parent, item)
+            if value is NoneAwaitable:
+                return None
+            if isinstance(value, Model) or not isinstance(value, Awaitable):
+                # 注意Model本身也是Awaitable
+                return value
+            return load_relation(parent, info, item, value)
+
+        return resolve_one
+
+
+class AggregateResolver:
+    """
+    自动生成的聚合字段的resolve，比如 eventsCount
+    同一层的所有行交给 AggregateLoader 合并成一条 GROUP BY 查询，不会把关联的行加载出来
+    """
+    __slots__ = ("aggregate_info",)
+
+    def __init__(self, aggregate_info: AggregateInfo):
+        self.aggregate_info = aggregate_info
+
+    def __call__(self, parent, info, **kwargs):
+        relation, function, column = self.aggregate_info
+        context = info.context if isinstance(info.context, dict) else {}
+        return get_aggregate_loader(context, get_model_type(parent), relation, function, column).load(parent)
+
+
 class GrapheneModelObjectMeta(SubclassWithMeta_Meta):
 
     @classmethod
@@ -53,82 +413,170 @@ class GrapheneModelObjectMeta(SubclassWithMeta_Meta):
                 return getattr(i, name)
         return default
 
+    @staticmethod
+    def is_list_field(v) -> bool:
+        return isinstance(v, GqlList) or (isinstance(v, Field) and isinstance(v._type, GqlList))
+
+    @staticmethod
+    def build_relation_field(list_type: GqlList, filter_args: Dict[str, dict]) -> Field:
+        """
+        列表字段加上first、orderBy和过滤参数，过滤参数的格式和 BaseCURD.filter_args 一样
+        不传参数的时候和原来一样加载整个关系
+        """
+        args = build_arguments(filter_args)
+        args[SLICE_LIMIT_ARG] = Int()
+        args[SLICE_ORDER_ARG] = String()
+        field = Field(list_type, args=args)
+        # 保持字段原来的顺序
+        field.creation_counter = list_type.creation_counter
+        return field
+
+    @classmethod
+    def build_aggregate_fields(mcs, ns, new_ns, auto_count_fields):
+        """
+        给列表类型的字段（反向外键和多对多）生成 <关系>_count 字段，
+        给 relation_aggregates 里的列生成 <关系>_min_<列> 和 <关系>_max_<列> 字段
+        已经定义了同名字段的话不会覆盖
+        """
+        ret = {}
+
+        def add(field_name, field, aggregate_info):
+            if field_name in ns:
+                return
+            new_ns[field_name] = field
+            new_ns.setdefault(f"resolve_{field_name}", AggregateResolver(aggregate_info))
+            ret[field_name] = aggregate_info
+
+        if auto_count_fields:
+            for k, v in ns.items():
+                if mcs.is_list_field(v):
+                    add(f"{k}_count", Int(), AggregateInfo(k, "count", None))
+        for relation, columns in ns.get("relation_aggregates", {}).items():
+            for column, type_ in columns.items():
+                for function in ("min", "max"):
+                    add(f"{relation}_{function}_{column}", type_(), AggregateInfo(relation, function, column))
+        return ret
+
     def __new__(mcs, name, bases, ns, **kwargs):
         resolve_fn = ns.get("resolve", mcs.get_resolve_from_base("resolve", bases))
         new_ns: dict = copy(ns)
+        # 字段名 -> AggregateInfo
+        aggregate_fields = dict(mcs.get_resolve_from_base("aggregate_fields", bases, {}))
+        if "model" in ns:
+            auto_count_fields = ns.get("auto_count_fields",
+                                       mcs.get_resolve_from_base("auto_count_fields", bases, True))
+            aggregate_fields.update(mcs.build_aggregate_fields(ns, new_ns, auto_count_fields))
+            relation_filter_args = ns.get("relation_filter_args",
+                                          mcs.get_resolve_from_base("relation_filter_args", bases, {}))
+            for k, v in ns.items():
+                if isinstance(v, GqlList):
+                    new_ns[k] = mcs.build_relation_field(v, relation_filter_args.get(k, {}))
+        new_ns["aggregate_fields"] = aggregate_fields
+        # 记录下哪些字段用的是自动生成的resolve，只有这些字段可以放心地只select对应的列
+        auto_resolve_fields = set(mcs.get_resolve_from_base("auto_resolve_fields", bases, ()))
         for k, v in ns.items():
             if resolve_fn is not None:
                 if isinstance(v, BaseType) or isinstance(v, MountedType) \
                         or isinstance(v, UnmountedType) or isinstance(v, Structure):
-                    new_ns.setdefault(f"resolve_{k}", partial(resolve_fn, k))
+                    if f"resolve_{k}" not in ns:
+                        auto_resolve_fields.add(k)
+                    if getattr(resolve_fn, "__func__", None) is GrapheneModelObject.resolve.__func__:
+                        # 没有覆盖resolve的话，用预先生成的取值函数，省掉每一行都要做的类型判断
+                        new_ns.setdefault(f"resolve_{k}", FieldResolver(k))
+                    else:
+                        new_ns.setdefault(f"resolve_{k}", partial(resolve_fn, k))
+        new_ns["auto_resolve_fields"] = frozenset(auto_resolve_fields)
+        if "model" in ns:
+            watch_model(ns["model"])
         cls = super().__new__(mcs, name, bases, new_ns, **kwargs)
         return cls
 
 
 class GrapheneModelObject(ObjectType, metaclass=GrapheneModelObjectMeta):
     model: Type[Model]
+    # 为False的时候不给列表字段生成 <关系>Count
+    auto_count_fields: bool = True
+    # 关系名 -> {列名: graphene类型}，生成 <关系>Min<列> 和 <关系>Max<列>，比如 {"events": {"id": Int}}
+    relation_aggregates: Dict[str, Dict[str, Type[BaseType]]] = {}
+    # 关系名 -> 这个列表字段可以用的过滤参数，格式和 BaseCURD.filter_args 一样
+    relation_filter_args: Dict[str, Dict[str, dict]] = {}
+    # 估计查询开销时每个字段的权重，key是字段名，没有列出的字段用default_field_cost，见 query_cost
+    field_costs: Dict[str, float] = {}
+    default_field_cost: float = 1
 
     @classmethod
-    async def resolve(cls, item, parent, info, **kwargs):
+    def get_field_cost(cls, field_name: str) -> float:
+        if field_name in cls.field_costs:
+            return cls.field_costs[field_name]
+        return cls.field_costs.get(to_underline(field_name), cls.default_field_cost)
 
+    @classmethod
+    async def resolve(cls, item, parent, info, **kwargs):
+        # 自动生成的字段用的是 FieldResolver，这里留给覆盖了resolve的子类调用
+        if isinstance(parent, Row):
+            return getattr(parent, item, None)
         if not isinstance(parent, Model) or item not in parent._meta.fields:
-            value = None
-            try:
-                # 如果是类似字典的，那么使用in操作
-                if item in parent:
-                    value = parent[item]
-            except TypeError:
-                # 如果使用in关键字发生异常，那么尝试取属性
-                try:
-                    if hasattr(parent, item):
-                        value = getattr(parent, item)
-                except:
-                    traceback.print_exc()
-            except:
-                traceback.print_exc()
-            return value
-
-        meta_info = parent._meta
-        if item in meta_info.fields_db_projection:
-            # 这种字段和数据库字段对应，可以直接取得值
-            return getattr(parent, item)
-        elif item in meta_info.fetch_fields:
-            # 这种字段可能需要加载
-            value = getattr(parent, item)
-            if not isinstance(value, QuerySet):
-                if isinstance(value, Awaitable):
-                    return await value
-                return value
-            else:
-                # 如果是查询集，那分情况讨论
-                if item in meta_info.o2o_fields or item in meta_info.fk_fields:
-                    # 一对一或者外键
-                    if isinstance(value, Awaitable):
-                        return await value
-                    return value
-                elif item in meta_info.backward_fk_fields or item in meta_info.m2m_fields:
-                    if isinstance(value, AsyncIterable):
-                        return [i async for i in value]
-                    return list(value)
-                assert False, "不该执行到这里"
-        assert False, "不该执行到这里"
+            return get_attr_or_item(parent, item)
+        value = FieldResolver(item).compile(type(parent))(parent, info, **kwargs)
+        if is_thenable(value):
+            return await value
+        return value
 
     @classmethod
     def prefetch_fn(cls, action_id, prefetch_name, prefetch_field_def,
-                    path: List[PrefetchPath], add_prefetch_info, set_action_id):
+                    path: List[PrefetchPath], add_prefetch_info, set_action_id, prefetch_args=None):
+        name_path = [i.related_name for i in path]
+        if path:
+            root = path[0].orm_type
+        else:
+            root = cls.model
+        owner_path = "__".join([to_underline(i) for i in name_path])
+
+        meta_info = cls.model._meta
+        if prefetch_name in meta_info.fetch_fields:
+            # 记下查询会读到的表，结果缓存靠它失效
+            add_prefetch_info(ReadInfo(cls.model, prefetch_name))
+            add_prefetch_info(ReadInfo(meta_info.fields_map[prefetch_name].related_model, None))
+
         if hasattr(cls, f"prefetch_{prefetch_name}"):
+            # 不知道自定义的prefetch会用到哪些列，只能整行加载
+            add_prefetch_info(SelectInfo(owner_path, None, root))
             return getattr(cls, f"prefetch_{prefetch_name}")(prefetch_name, prefetch_field_def, path)
 
-        meta_info = cls.model._meta
+        if prefetch_name.startswith("__"):
+            # __typename 之类的
+            return SKIP
+
+        aggregate_info = cls.aggregate_fields.get(to_underline(prefetch_name))
+        if aggregate_info is not None:
+            # 聚合由 AggregateLoader 单独查询，这一层只需要主键
+            relation = aggregate_info.relation
+            add_prefetch_info(ReadInfo(cls.model, relation))
+            add_prefetch_info(ReadInfo(meta_info.fields_map[relation].related_model, None))
+            add_prefetch_info(SelectInfo(owner_path, meta_info.pk_attr, root))
+            return SKIP
+
         if prefetch_name not in meta_info.fetch_fields:
+            column = to_underline(prefetch_name)
+            if column not in meta_info.fields_db_projection or column not in cls.auto_resolve_fields:
+                # 不是数据库里的列，或者自定义了resolve，不知道会用到哪些列
+                column = None
+            add_prefetch_info(SelectInfo(owner_path, column, root))
             return SKIP
 
-        name_path = [i.related_name for i in path]
-        if path:
-            root = path[0].orm_type
-        else:
-            root = cls.model
         prefetch_path = "__".join([to_underline(i) for i in name_path + [prefetch_name]])
+        if prefetch_args and (prefetch_name in meta_info.backward_fk_fields or prefetch_name in meta_info.m2m_fields):
+            try:
+                slice_args = get_slice_args(prefetch_args, meta_info.fields_map[prefetch_name].related_model)
+            except ValueError:
+                # 参数不合法，这个关系和它下面的都不预先加载，留给字段的resolver在这个字段的路径上报错
+                # 否则根列表的prefetch出错，整个列表都会变成null
+                add_prefetch_info(SliceInfo(prefetch_path, None, root))
+                return PrefetchPath(prefetch_name, cls.model)
+            if slice_args:
+                # 每个父对象只取一部分，不能交给orm的prefetch，见 prefetch_relation_slices
+                add_prefetch_info(SliceInfo(prefetch_path, slice_args, root))
+                return PrefetchPath(prefetch_name, cls.model)
         add_prefetch_info(PrefetchInfo(prefetch_path, root))
         return PrefetchPath(prefetch_name, cls.model)
 
@@ -139,9 +587,23 @@ class BaseCURD:
         "page_size": {"type": Int, "default_value": 30}
     }
 
+    # filter_args 里面这些是分页用的，不是过滤条件
+    pagination_args = {"page", "page_size"}
+
     query_set: QuerySet = ...
     model_object: GrapheneModelObject = ...
     name: str = ...
+    # 游标分页和列表都按照这些字段排序，最后一个字段必须是唯一的，默认是主键
+    cursor_fields: List[str] = ...
+    # 大于0的时候缓存count的结果，单位是秒，缓存是进程内的，多进程模式下别的worker写了数据不会失效
+    count_cache_ttl: float = 0
+    # 批量写的时候一条sql最多写这么多行，同时受 bulk.MAX_SQL_PARAMETERS 的限制
+    bulk_batch_size: int = 500
+    # 为True的时候list、retrieve和page返回 rows.Row 行对象而不是模型实例，省掉构造模型的开销
+    # 只适合model_object上自定义的resolve只读取字段、不调用模型方法的情况
+    fast_read: bool = False
+    # 流式执行的时候顶层的列表每次查询这么多行，见 stream_list
+    stream_chunk_size: int = 500
 
     @classmethod
     def wrap_resolver(cls, func: Callable):
@@ -154,45 +616,81 @@ class BaseCURD:
             return cls.model_object.model.__name__
         return cls.name
 
+    @classmethod
+    def get_model(cls) -> Type[Model]:
+        # 这里不能构造查询集，orm可能还没有初始化
+        if cls.query_set is ...:
+            return cls.model_object.model
+        return cls.query_set.model
+
     @classmethod
     def get_underline_name(cls):
         name = cls.get_name()
         return to_underline(name)
 
     @classmethod
-    def do_prefetch(cls, query_set, prefetch: List[PrefetchInfo]):
-        ret = query_set
-        for i in prefetch:
-            if i.orm_type is query_set.model:
-                ret = query_set.prefetch_related(i.prefetch_path)
-                print(f"prefetch {query_set.model} {i.prefetch_path}")
-        return ret
+    def do_prefetch(cls, query_set, prefetch: List[PrefetchInfo], extra_fields=()):
+        # 所有的路径要一起规划，分开调用prefetch_related的话只有最后一次生效
+        prefetch = [i for i in prefetch if i.orm_type is query_set.model]
+        sliced_paths = {i.prefetch_path for i in prefetch if isinstance(i, SliceInfo)}
+        prefetched_paths = {i.prefetch_path for i in prefetch if isinstance(i, PrefetchInfo)}
+        tree = build_prefetch_tree(i for i in prefetched_paths
+                                   if not is_under_slice(i, sliced_paths, prefetched_paths))
+        columns = build_select_columns(i for i in prefetch if isinstance(i, SelectInfo))
+        return apply_prefetch_tree(query_set, tree, columns=columns, extra_fields=extra_fields)
+
+    @classmethod
+    def use_rows(cls, prefetch) -> bool:
+        # 切片要挂在模型实例上，带切片的查询仍然走模型
+        if not cls.fast_read or prefetch is None:
+            return False
+        return not any(isinstance(i, SliceInfo) for i in prefetch)
 
     @classmethod
-    def get_query_set(cls, prefetch=None):
+    async def fetch_rows(cls, query_set, prefetch: List[PrefetchInfo], extra_fields=(),
+                         identity_map: IdentityMap = None) -> List[Row]:
+        # 和 do_prefetch 同样的规划，只是每一层都查成行对象
+        prefetch = [i for i in prefetch if i.orm_type is query_set.model]
+        tree = build_prefetch_tree(i.prefetch_path for i in prefetch if isinstance(i, PrefetchInfo))
+        columns = build_select_columns(i for i in prefetch if isinstance(i, SelectInfo))
+        columns.setdefault("", set()).update(extra_fields)
+        return await fetch_row_list(query_set, tree, columns, identity_map)
+
+    @classmethod
+    def get_query_set(cls, prefetch=None, extra_fields=()):
         if cls.query_set is ...:
             assert hasattr(cls.model_object, "model")
             qs = cls.model_object.model.all()
         else:
             qs = cls.query_set
         if prefetch is not None:
-            return cls.do_prefetch(qs, prefetch)
+            return cls.do_prefetch(qs, prefetch, extra_fields)
         return qs
 
     @classmethod
     def get_list_args(cls):
-        ret = {}
-        for k, v in cls.filter_args.items():
-            args = {}
-            if "default_value" in v:
-                args["default_value"] = v["default_value"]
-            ret[k] = v.get("type", String)(**args)
-        return ret
+        return build_arguments(cls.filter_args)
 
     @classmethod
     def get_list_def(cls):
         return Field(GqlList(cls.model_object), args=cls.get_list_args())
 
+    @classmethod
+    def get_page_args(cls):
+        ret = {k: v for k, v in cls.get_list_args().items() if k not in cls.pagination_args}
+        ret["first"] = Int(default_value=30)
+        ret["after"] = String()
+        return ret
+
+    @classmethod
+    def get_page_def(cls):
+        page_type = type(f"{cls.get_name()}Page", (ObjectType,), {
+            "items": GqlList(cls.model_object),
+            "end_cursor": String(),
+            "has_next_page": Boolean(),
+        })
+        return Field(page_type, args=cls.get_page_args())
+
     @classmethod
     def get_retrieve_def(cls):
         return Field(cls.model_object, pk=Int())
@@ -210,20 +708,128 @@ class BaseCURD:
         return ret
 
     @classmethod
-    def filter_query_set(cls, prefetch=None, *_, page=0, page_size=30, **kwargs):
-        assert not _, "奇怪的位置参数增加了"
+    def get_filter_kwargs(cls, kwargs):
         filter_args = {}
-        allow = cls.get_all_allow_filter_args()
+        allow = cls.get_all_allow_filter_args() - cls.pagination_args
         for k in kwargs:
             if k in allow:
                 filter_args[k] = kwargs[k]
-        return cls.get_query_set(prefetch).filter(**filter_args).limit(page_size).offset(page * page_size)
+        return filter_args
+
+    @classmethod
+    def filter_query_set(cls, prefetch=None, *_, page=0, page_size=30, **kwargs):
+        assert not _, "奇怪的位置参数增加了"
+        filter_args = cls.get_filter_kwargs(kwargs)
+        # 和 keyset_query_set 一样按游标字段排序，流式输出的列表才和一次输出的内容、顺序都一样
+        qs = cls.get_query_set(prefetch).filter(**filter_args).order_by(*cls.get_cursor_fields())
+        return qs.limit(page_size).offset(page * page_size)
+
+    @classmethod
+    def get_cursor_fields(cls):
+        if cls.cursor_fields is ...:
+            return [cls.model_object.model._meta.pk_attr]
+        return list(cls.cursor_fields)
+
+    @staticmethod
+    def encode_cursor(values) -> str:
+        return urlsafe_b64encode(json.dumps(values, default=str).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        try:
+            return json.loads(urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise ValueError(f"无效的游标: {cursor}")
+
+    @classmethod
+    def keyset_query_set(cls, prefetch=None, *_, first=30, after=None, offset=0, **kwargs):
+        """
+        游标分页，用 WHERE (a, b) > (x, y) 定位到上一页的末尾，而不是用offset扫过前面所有的行
+        所以不管翻到多深，每一页的代价都一样
+        多取一行用来判断还有没有下一页
+        offset 只给 stream_list 的第一段用
+        """
+        assert not _, "奇怪的位置参数增加了"
+        if first <= 0:
+            raise ValueError("first 必须大于0")
+        cursor_fields = cls.get_cursor_fields()
+        qs = cls.get_query_set(prefetch, extra_fields=cursor_fields).filter(**cls.get_filter_kwargs(kwargs))
+        if after is not None:
+            values = cls.decode_cursor(after)
+            if not isinstance(values, list) or len(values) != len(cursor_fields):
+                raise ValueError(f"无效的游标: {after}")
+            # 展开成 a > x OR (a = x AND b > y) 的形式
+            condition = None
+            for i, field in enumerate(cursor_fields):
+                q = Q(**{f"{field}__gt": values[i]}, **dict(zip(cursor_fields[:i], values[:i])))
+                condition = q if condition is None else condition | q
+            qs = qs.filter(condition)
+        qs = qs.order_by(*cursor_fields).limit(first + 1)
+        if offset:
+            qs = qs.offset(offset)
+        return qs
+
+    @classmethod
+    async def fetch_keyset_page(cls, prefetch, identity_map: IdentityMap, first=30, after=None, **kwargs):
+        """
+        按游标取一页，返回 (items, has_next_page)，page 和 stream_list 共用
+        """
+        use_rows = cls.use_rows(prefetch)
+        if use_rows:
+            qs = cls.keyset_query_set(first=first, after=after, **kwargs)
+            items = await cls.fetch_rows(qs, prefetch, extra_fields=cls.get_cursor_fields(),
+                                         identity_map=identity_map)
+        else:
+            qs = cls.keyset_query_set(prefetch, first=first, after=after, **kwargs)
+            items = [i async for i in qs]
+        has_next_page = len(items) > first
+        items = items[:first]
+        if not use_rows:
+            await prefetch_relation_slices(cls.get_model(), items, prefetch)
+            items = identity_map.intern_graph(items)
+        return items, has_next_page
+
+    @classmethod
+    async def stream_list(cls, context: dict, prefetch, *_, page=0, page_size=30, **kwargs):
+        """
+        流式执行的时候顶层的列表按游标一段一段地查询，每段最多 stream_chunk_size 行，
+        每一段换新的identity map和加载器，前面的段输出之后就可以释放，内存只和一段的大小有关
+        顺序按游标字段，和 filter_query_set 一样
+        """
+        assert not _, "奇怪的位置参数增加了"
+        # 和 filter_query_set 一样，limit(0) 就是不限制行数
+        remaining = page_size if page_size > 0 else None
+        offset = page * page_size
+        after = None
+        while remaining is None or remaining > 0:
+            identity_map = context["identity_map"] = IdentityMap()
+            context["loaders"] = {}
+            first = cls.stream_chunk_size if remaining is None else min(remaining, cls.stream_chunk_size)
+            items, has_next_page = await cls.fetch_keyset_page(prefetch, identity_map, first, after,
+                                                               offset=offset, **kwargs)
+            if items:
+                yield items
+            if not items or not has_next_page:
+                return
+            if remaining is not None:
+                remaining -= len(items)
+            offset = 0
+            after = cls.encode_cursor([getattr(items[-1], i) for i in cls.get_cursor_fields()])
 
     @classmethod
     def build_list_fn(cls) -> Callable[..., Awaitable[List[Model]]]:
         @cls.wrap_resolver
         async def fn(parent, info, **kwargs):
-            return [i async for i in cls.filter_query_set(info.context.get("prefetch", {}).get(fn.action_id), **kwargs)]
+            prefetch = info.context.get("prefetch", {}).get(fn.action_id)
+            if info.context.get("stream") and len(info.path) == 1:
+                # 流式执行的顶层列表，见 graphene_executor.ListStream
+                return cls.stream_list(info.context, prefetch, **kwargs)
+            identity_map = get_identity_map(info.context)
+            if cls.use_rows(prefetch):
+                return await cls.fetch_rows(cls.filter_query_set(**kwargs), prefetch, identity_map=identity_map)
+            items = [i async for i in cls.filter_query_set(prefetch, **kwargs)]
+            await prefetch_relation_slices(cls.get_model(), items, prefetch)
+            return identity_map.intern_graph(items)
 
         return fn
 
@@ -231,16 +837,54 @@ class BaseCURD:
     def build_retrieve_fn(cls) -> Callable[..., Awaitable[Model]]:
         @cls.wrap_resolver
         async def fn(parent, info, pk):
-            return await cls.filter_query_set(
-                info.context.get("prefetch", {}).get(fn.action_id)).get(pk=pk)
+            prefetch = info.context.get("prefetch", {}).get(fn.action_id)
+            identity_map = get_identity_map(info.context)
+            if cls.use_rows(prefetch):
+                items = await cls.fetch_rows(cls.filter_query_set().filter(pk=pk), prefetch, identity_map=identity_map)
+                if not items:
+                    raise DoesNotExist("Object does not exist")
+                return items[0]
+            item = await cls.filter_query_set(prefetch).get(pk=pk)
+            await prefetch_relation_slices(cls.get_model(), [item], prefetch)
+            return identity_map.intern_graph([item])[0]
 
         return fn
 
     @classmethod
-    def build_count_fn(cls) -> Callable[..., Awaitable[Model]]:
+    def build_page_fn(cls) -> Callable[..., Awaitable[dict]]:
+        @cls.wrap_resolver
+        async def fn(parent, info, first=30, after=None, **kwargs):
+            prefetch = info.context.get("prefetch", {}).get(fn.action_id)
+            items, has_next_page = await cls.fetch_keyset_page(prefetch, get_identity_map(info.context), first,
+                                                               after, **kwargs)
+            end_cursor = after
+            if items:
+                end_cursor = cls.encode_cursor([getattr(items[-1], i) for i in cls.get_cursor_fields()])
+            return {"items": items, "end_cursor": end_cursor, "has_next_page": has_next_page}
+
+        return fn
+
+    @classmethod
+    def count_query_set(cls, **kwargs):
+        # count只需要过滤条件，不能带上分页的limit和offset
+        return cls.get_query_set().filter(**cls.get_filter_kwargs(kwargs))
+
+    @classmethod
+    def build_count_fn(cls) -> Callable[..., Awaitable[int]]:
+        model = cls.get_model()
+        watch_model(model)
+
         @cls.wrap_resolver
         async def fn(parent, info, **kwargs):
-            count = await cls.filter_query_set(**kwargs).count()
+            if cls.count_cache_ttl <= 0:
+                return await cls.count_query_set(**kwargs).count()
+            # key里带上表的版本号，表被写过之后旧的缓存自然就取不到了
+            # 表名要等orm初始化之后才有，所以在这里取
+            key = (cls, get_version(get_table(model)), freeze(cls.get_filter_kwargs(kwargs)))
+            count = count_cache.get(key)
+            if count is MISSING:
+                count = await cls.count_query_set(**kwargs).count()
+                count_cache.set(key, count, ttl=cls.count_cache_ttl)
             return count
 
         return fn
@@ -248,11 +892,106 @@ class BaseCURD:
     name_map = {
         "retrieve": ("get_retrieve_def", "build_retrieve_fn"),
         "list": ("get_list_def", "build_list_fn"),
+        "page": ("get_page_def", "build_page_fn"),
         "count": ("get_count_def", "build_count_fn")
     }
 
     action_id_map = {}
 
+    # 批量写的mutation，由 GraphQLMutationViewSet 生成
+    mutation_name_map = {
+        "bulk_create": ("get_bulk_create_def", "build_bulk_create_fn"),
+        "bulk_update": ("get_bulk_update_def", "build_bulk_update_fn"),
+        "bulk_delete": ("get_bulk_delete_def", "build_bulk_delete_fn"),
+    }
+
+    @classmethod
+    def get_input_fields(cls, pk_required: bool):
+        """
+        model_object 上和数据库的列对应的标量字段，外键写成 xxx_id，多对多写成 xxx（关联对象主键的列表）
+        反向的多对多要等orm初始化之后才有，不管schema什么时候构建都不生成
+        """
+        meta_info = cls.get_model()._meta
+        ret = {}
+        for name, field in cls.model_object._meta.fields.items():
+            type_ = field.type
+            if isinstance(type_, type) and issubclass(type_, Scalar) and name in meta_info.fields_db_projection:
+                ret[name] = type_(required=pk_required and name == meta_info.pk_attr)
+        for name in sorted(meta_info.fk_fields):
+            ret[f"{name}_id"] = Int()
+        for name in sorted(meta_info.m2m_fields):
+            if not getattr(meta_info.fields_map[name], "_generated", False):
+                ret[name] = GqlList(NonNull(Int))
+        return ret
+
+    @classmethod
+    def get_bulk_create_def(cls):
+        input_type = type(f"{cls.get_name()}CreateInput", (InputObjectType,), cls.get_input_fields(False))
+        return Field(GqlList(Int), args={"items": GqlList(NonNull(input_type), required=True)})
+
+    @classmethod
+    def get_bulk_update_def(cls):
+        input_type = type(f"{cls.get_name()}UpdateInput", (InputObjectType,), cls.get_input_fields(True))
+        return Field(GqlList(Int), args={"items": GqlList(NonNull(input_type), required=True)})
+
+    @classmethod
+    def get_bulk_delete_def(cls):
+        return Field(GqlList(Int), args={"ids": GqlList(NonNull(Int), required=True)})
+
+    @classmethod
+    async def run_bulk(cls, fn, rows, m2m_fields=(), cascade=False):
+        """
+        在一个事务里执行批量写，出错的话整个回滚
+        """
+        model = cls.get_model()
+        async with in_transaction(model._meta.default_connection) as connection:
+            try:
+                return await fn(model, rows, connection, cls.bulk_batch_size)
+            finally:
+                # 批量写不触发信号，要自己加版本号
+                # 外层还有事务的话，等外层的事务结束再加，见 model_version.bump_on
+                bump_on(connection, *get_written_tables(model, m2m_fields, cascade))
+
+    @classmethod
+    def get_m2m_names(cls, rows):
+        m2m_fields = cls.get_model()._meta.m2m_fields
+        return {k for i in rows for k in i if k in m2m_fields}
+
+    @classmethod
+    def build_bulk_create_fn(cls) -> Callable[..., Awaitable[list]]:
+        @cls.wrap_resolver
+        async def fn(parent, info, items):
+            rows = [dict(i) for i in items]
+            return await cls.run_bulk(bulk_insert, rows, cls.get_m2m_names(rows))
+
+        return fn
+
+    @classmethod
+    def build_bulk_update_fn(cls) -> Callable[..., Awaitable[list]]:
+        @cls.wrap_resolver
+        async def fn(parent, info, items):
+            rows = [dict(i) for i in items]
+            return await cls.run_bulk(bulk_update, rows, cls.get_m2m_names(rows))
+
+        return fn
+
+    @classmethod
+    def build_bulk_delete_fn(cls) -> Callable[..., Awaitable[list]]:
+        @cls.wrap_resolver
+        async def fn(parent, info, ids):
+            return await cls.run_bulk(bulk_delete, list(ids), cascade=True)
+
+        return fn
+
+    @classmethod
+    def get_all_mutation(cls):
+        ret = {}
+        for k, v in cls.mutation_name_map.items():
+            field_name = f"{cls.get_underline_name()}_{k}"
+            ret[field_name] = getattr(cls, v[0])()
+            ret[f"resolve_{field_name}"] = getattr(cls, v[1])()
+        return ret
+
     @classmethod
     def get_all_action(cls, prefix=None):
         if prefix is None:
@@ -273,6 +1012,7 @@ class BaseCURD:
 
 class ViewSetMeta(SubclassWithMeta_Meta):
     action_name_to_id_map = {}
+    action_name_to_curd_map = {}
 
 
 
@@ -286,6 +1026,8 @@ class ViewSetMeta(SubclassWithMeta_Meta):
             define, action_id = curd.get_all_action()
             ns.update(define)
             mcs.action_name_to_id_map.update({to_camel(v): k for k, v in action_id.items()})
+            mcs.action_name_to_curd_map.update({to_camel(v): curd for v in action_id.values()})
+            watch_model(curd.get_model())
         return super().__new__(mcs, name, bases, ns, **kwargs)
 
 
@@ -293,9 +1035,25 @@ class GraphQLViewSet(ObjectType, metaclass=ViewSetMeta):
 
     @classmethod
     def prefetch_fn(cls, action_id, prefetch_name, prefetch_field_def, path: List[PrefetchPath],
-                    add_prefetch_info, set_action_id):
+                    add_prefetch_info, set_action_id, prefetch_args=None):
         assert action_id is None
         set_action_id(cls.action_name_to_id_map[prefetch_name])
+        add_prefetch_info(ReadInfo(cls.action_name_to_curd_map[prefetch_name].get_model(), None))
         return SKIP
 
     curds: List[BaseCURD] = []
+
+
+class MutationViewSetMeta(SubclassWithMeta_Meta):
+
+    def __new__(mcs, name, bases, ns, **kwargs):
+        # 和 ViewSetMeta 一样，给每个curd生成mutation
+        curds: List[BaseCURD] = ns.get("curds", [])
+        for curd in curds:
+            ns.update(curd.get_all_mutation())
+            watch_model(curd.get_model())
+        return super().__new__(mcs, name, bases, ns, **kwargs)
+
+
+class GraphQLMutationViewSet(ObjectType, metaclass=MutationViewSetMeta):
+    curds: List[BaseCURD] = []
@@ -8,7 +8,9 @@
 """
 
 from model import *
-from graphene_model_base import BaseCURD, GraphQLViewSet, GrapheneModelObject
+from graphene_model_base import BaseCURD, GraphQLViewSet, GraphQLMutationViewSet, GrapheneModelObject
+from functools import lru_cache
+
 from graphene import Int, String, Field, List, Schema
 
 
@@ -32,6 +34,10 @@ class TournamentObject(GrapheneModelObject):
     id = Int()
     name = String()
     events = List(EventObject)
+    # 生成 eventsMinId 和 eventsMaxId
+    relation_aggregates = {"events": {"id": Int}}
+    # events(first: 2, orderBy: "-id", name: "xxx")
+    relation_filter_args = {"events": {"name": {"type": String}}}
 
 
 class TournamentCurd(BaseCURD):
@@ -50,5 +56,23 @@ class DemoViewSet(GraphQLViewSet):
     curds = [TournamentCurd, EventCurd, TeamCurd]
 
 
-schema = Schema(query=DemoViewSet)
-print(schema)
+class DemoMutationViewSet(GraphQLMutationViewSet):
+    curds = [TournamentCurd, EventCurd, TeamCurd]
+
+
+@lru_cache(maxsize=None)
+def get_schema() -> Schema:
+    # schema在第一次用到的时候才构建，导入这个模块没有别的副作用
+    return Schema(query=DemoViewSet, mutation=DemoMutationViewSet)
+
+
+def __getattr__(name):
+    # 兼容 from graphgl_api import schema 的写法
+    if name == "schema":
+        return get_schema()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if __name__ == "__main__":
+    # python graphgl_api.py > schema.graphql 导出SDL
+    print(get_schema())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   identity_map.py
+@Time    :   2021/3/16 10:20
+@Desc    :   请求内的identity map，同一行在一次请求里只保留一个对象
+"""
+from typing import Type, Dict, Tuple, Any, List, Iterable
+
+from tortoise import Model
+from tortoise.fields.relational import ReverseRelation
+
+from cache import MISSING
+
+
+class IdentityMap:
+    """
+    模型实例按 (模型, 主键) 去重，同一行后加载的实例合并到先加载的实例上再丢掉，
+    所以先加载的实例会带上所有路径上加载过的列和关系
+    行对象（见 rows）是不可变的，按 (形状, 主键) 去重，形状相同的行列和关系都一样，可以直接复用
+    """
+
+    def __init__(self):
+        self.objects: Dict[Tuple, Any] = {}
+        # 被去重掉的对象个数
+        self.hits = 0
+        # 模型 -> 实例上缓存关系的属性名
+        self.relation_keys: Dict[Type[Model], List[str]] = {}
+        # 已经合并过的实例，关系可能有环，同一个实例只合并一次；保留引用，id才不会被别的对象复用
+        self.merged: Dict[int, Model] = {}
+
+    def __contains__(self, key: Tuple) -> bool:
+        return key in self.objects
+
+    def get(self, key: Tuple, default=None):
+        value = self.objects.get(key, default)
+        if value is not default:
+            self.hits += 1
+        return value
+
+    def set(self, key: Tuple, value):
+        self.objects[key] = value
+
+    def get_relation_keys(self, model: Type[Model]) -> List[str]:
+        # tortoise把加载好的关系存在实例的 _<关系名> 属性里，切片存在 _relation_slices 里
+        keys = self.relation_keys.get(model)
+        if keys is None:
+            keys = self.relation_keys[model] = [f"_{i}" for i in model._meta.fetch_fields] + ["_relation_slices"]
+        return keys
+
+    def merge(self, target: Model, source: Model):
+        # 把source上有而target上没有的列和关系搬到target上
+        if id(source) in self.merged:
+            return
+        self.merged[id(source)] = source
+        target_dict = target.__dict__
+        for k, v in source.__dict__.items():
+            current = target_dict.get(k, MISSING)
+            if current is MISSING:
+                target_dict[k] = v
+            elif isinstance(current, Model) and isinstance(v, Model):
+                self.intern(v)
+            elif isinstance(current, ReverseRelation) and isinstance(v, ReverseRelation) and v._fetched:
+                if not current._fetched:
+                    target_dict[k] = v
+                else:
+                    # 两边加载的是同一批行，source这边的行上可能有别的列和关系，也要合并进去
+                    self.intern_list(v.related_objects)
+            elif k == "_relation_slices":
+                for args, value in v.items():
+                    current.setdefault(args, value)
+        if target._partial:
+            # 两边只加载了部分列的时候，合并之后可能已经有了所有的列，这样的实例才能save
+            target._partial = any(k not in target_dict for k in target._meta.fields_db_projection)
+
+    def intern(self, instance: Model) -> Model:
+        key = (type(instance), instance.pk)
+        canonical = self.objects.get(key)
+        if canonical is None:
+            self.objects[key] = instance
+            return instance
+        if canonical is not instance:
+            self.merge(canonical, instance)
+            self.hits += 1
+        return canonical
+
+    def intern_list(self, instances: Iterable[Model]) -> List[Model]:
+        return [self.intern(i) for i in instances]
+
+    def intern_graph(self, instances: Iterable[Model]) -> List[Model]:
+        """
+        instances 和从它们出发已经加载的关系都换成去重后的实例，返回去重后的instances
+        """
+        ret = self.intern_list(instances)
+        stack = list(ret)
+        visited = set()
+        while stack:
+            instance = stack.pop()
+            if id(instance) in visited:
+                continue
+            visited.add(id(instance))
+            instance_dict = instance.__dict__
+            for key in self.get_relation_keys(type(instance)):
+                value = instance_dict.get(key)
+                if value is None:
+                    continue
+                if isinstance(value, Model):
+                    value = instance_dict[key] = self.intern(value)
+                    stack.append(value)
+                elif isinstance(value, ReverseRelation):
+                    if value._fetched:
+                        value.related_objects = self.intern_list(value.related_objects)
+                        stack.extend(value.related_objects)
+                elif isinstance(value, dict):
+                    for args, related in value.items():
+                        related = value[args] = self.intern_list(related)
+                        stack.extend(related)
+        return ret
+
+
+def get_identity_map(context) -> IdentityMap:
+    """
+    取得请求内共享的identity map，放在 context["identity_map"] 里
+    context不是字典的时候每次返回新的，也就是不去重
+    """
+    if not isinstance(context, dict):
+        return IdentityMap()
+    identity_map = context.get("identity_map")
+    if identity_map is None:
+        identity_map = context["identity_map"] = IdentityMap()
+    return identity_map
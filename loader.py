@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   loader.py
+@Time    :   2021/3/2 16:40
+@Desc    :   类似DataLoader的关系加载器，兜底没有被prefetch的关系
+"""
+import asyncio
+from functools import partial
+from typing import Type, Dict, Tuple, Any, List, Optional, Set
+
+from pypika import Order
+from pypika.analytics import RowNumber
+from tortoise import Model
+from tortoise.functions import Count, Min, Max
+from tortoise.queryset import QuerySet
+
+from cache import freeze
+from identity_map import IdentityMap, get_identity_map
+
+
+class BatchLoader:
+    """
+    收集同一轮事件循环里的加载请求，在 batch_load 里一次加载
+    加载过的结果在请求内缓存，同一行不会查第二次
+    """
+
+    def __init__(self):
+        # pk -> 加载好的值
+        self.cache: Dict[Any, Any] = {}
+        # pk -> (实例, future)
+        self.pending: Dict[Any, Tuple[Model, asyncio.Future]] = {}
+        # 正在执行的dispatch任务，事件循环只保留任务的弱引用，没有引用的任务可能在执行中途被回收
+        self.tasks: Set[asyncio.Task] = set()
+
+    def load(self, instance: Model) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        pk = instance.pk
+        if pk in self.cache:
+            future = loop.create_future()
+            future.set_result(self.cache[pk])
+            return future
+        if pk in self.pending:
+            return self.pending[pk][1]
+        if not self.pending:
+            # 等这一轮的其他resolve都把请求交上来了再一起查
+            loop.call_soon(self.start_dispatch)
+        future = loop.create_future()
+        self.pending[pk] = (instance, future)
+        return future
+
+    async def batch_load(self, instances: List[Model]) -> Dict[Any, Any]:
+        # 返回 pk -> 值
+        raise NotImplementedError
+
+    def start_dispatch(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        task = asyncio.get_event_loop().create_task(self.dispatch(pending))
+        self.tasks.add(task)
+        task.add_done_callback(partial(self.dispatch_done, pending))
+
+    def dispatch_done(self, pending: Dict[Any, Tuple[Model, asyncio.Future]], task: asyncio.Task):
+        self.tasks.discard(task)
+        # 任务被取消的时候（可能还没开始执行）future都还没有结果，取消掉，等待的resolver才不会一直挂着
+        for _, future in pending.values():
+            if not future.done():
+                future.cancel()
+
+    async def dispatch(self, pending: Dict[Any, Tuple[Model, asyncio.Future]]):
+        instances = [i for i, _ in pending.values()]
+        try:
+            values = await self.batch_load(instances)
+        except Exception as e:
+            for _, future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for pk, (instance, future) in pending.items():
+            value = values.get(pk)
+            self.cache[pk] = value
+            if not future.done():
+                future.set_result(value)
+
+
+class RelationLoader(BatchLoader):
+    """
+    对同一个关系的加载请求合并成一条 WHERE ... IN (...) 查询
+    加载出来的对象经过请求内的identity map去重
+    """
+
+    def __init__(self, model: Type[Model], relation: str, identity_map: Optional[IdentityMap] = None):
+        assert relation in model._meta.fetch_fields, f"{model.__name__}.{relation} 不是关系"
+        super().__init__()
+        self.model = model
+        self.relation = relation
+        self.many = relation in model._meta.backward_fk_fields or relation in model._meta.m2m_fields
+        self.identity_map = identity_map or IdentityMap()
+
+    def get_value(self, instance: Model):
+        value = getattr(instance, self.relation)
+        if self.many:
+            return self.identity_map.intern_list(value)
+        if isinstance(value, Model):
+            return self.identity_map.intern(value)
+        return value
+
+    async def batch_load(self, instances: List[Model]) -> Dict[Any, Any]:
+        await self.model.fetch_for_list(instances, self.relation)
+        return {i.pk: self.get_value(i) for i in instances}
+
+
+# 聚合的名字 -> tortoise的聚合函数
+AGGREGATE_FUNCTIONS = {"count": Count, "min": Min, "max": Max}
+
+
+class AggregateLoader(BatchLoader):
+    """
+    反向外键和多对多关系上的聚合，同一轮的请求合并成一条 GROUP BY 查询
+    count不需要column，min和max是对关联模型上的column聚合
+    """
+
+    def __init__(self, model: Type[Model], relation: str, function: str, column: Optional[str] = None):
+        meta_info = model._meta
+        assert relation in meta_info.backward_fk_fields or relation in meta_info.m2m_fields, \
+            f"{model.__name__}.{relation} 不是反向外键或者多对多关系"
+        assert function in AGGREGATE_FUNCTIONS, f"不支持的聚合: {function}"
+        assert function == "count" or column, f"{function} 需要指定列"
+        super().__init__()
+        self.model = model
+        self.relation = relation
+        self.function = function
+        self.column = column
+        related_model = meta_info.fields_map[relation].related_model
+        self.column_field = related_model._meta.fields_map[column] if column else None
+
+    def to_python(self, value):
+        if self.function == "count":
+            return value or 0
+        if value is None:
+            return None
+        return self.column_field.to_python_value(value)
+
+    async def batch_load(self, instances: List[Model]) -> Dict[Any, Any]:
+        pk_attr = self.model._meta.pk_attr
+        target = self.relation if self.column is None else f"{self.relation}__{self.column}"
+        query_set = self.model.filter(**{f"{pk_attr}__in": [i.pk for i in instances]}) \
+            .annotate(aggregate_value=AGGREGATE_FUNCTIONS[self.function](target)) \
+            .group_by(pk_attr).values_list(pk_attr, "aggregate_value")
+        # tortoise的values_list对关联字段上的聚合取错了列，只用它生成sql
+        _, rows = await self.model._meta.db.execute_query(query_set.sql())
+        return {pk: self.to_python(value) for pk, value in rows}
+
+
+# 这两个是切片参数，其余的都是过滤条件
+SLICE_LIMIT_ARG = "first"
+SLICE_ORDER_ARG = "order_by"
+
+
+def get_slice_args(kwargs, related_model: Optional[Type[Model]] = None) -> Tuple:
+    """
+    列表字段的参数整理成可以作为key的形式，值为None的参数不算
+    返回空元组表示不需要切片，和没有参数的时候一样加载整个关系
+    给了关联的模型的话还会检查first和orderBy，不合法的时候抛出ValueError，见 check_slice_args
+    """
+    ret = tuple(sorted((k, freeze(v)) for k, v in kwargs.items() if v is not None))
+    if related_model is not None:
+        check_slice_args(related_model, ret)
+    return ret
+
+
+def parse_order_by(model: Type[Model], order_by: Optional[str]) -> List[Tuple[str, Order]]:
+    """
+    "-name,id" 解析成 [("name", desc), ("id", asc)]，最后总是加上主键，保证每一页的顺序是确定的
+    """
+    meta_info = model._meta
+    ret = []
+    for i in (order_by or "").split(","):
+        i = i.strip()
+        if not i:
+            continue
+        order = Order.asc
+        if i.startswith("-"):
+            i, order = i[1:], Order.desc
+        if i not in meta_info.fields_db_projection:
+            raise ValueError(f"不能按照 {i} 排序")
+        ret.append((i, order))
+    if meta_info.pk_attr not in [i for i, _ in ret]:
+        ret.append((meta_info.pk_attr, Order.asc))
+    return ret
+
+
+def check_slice_args(related_model: Type[Model], slice_args: Tuple):
+    # 在发出任何sql之前检查切片参数
+    kwargs = dict(slice_args)
+    first = kwargs.get(SLICE_LIMIT_ARG)
+    if first is not None and first <= 0:
+        raise ValueError("first 必须大于0")
+    parse_order_by(related_model, kwargs.get(SLICE_ORDER_ARG))
+
+
+async def fetch_relation_slice(model: Type[Model], relation: str, instances: List[Model], slice_args: Tuple,
+                               query_set: Optional[QuerySet] = None) -> Dict[Any, List[Model]]:
+    """
+    反向外键和多对多关系的切片，每个父对象最多取first个，可以排序和过滤
+    第一条sql用 ROW_NUMBER() OVER (PARTITION BY 父对象) 在数据库里截断每个父对象的关系，只取回主键
+    第二条sql按主键取回关联的对象，query_set 是给这一条查询用的，可以带上prefetch和投影
+    返回 父对象的pk -> 关联对象的列表
+    """
+    meta_info = model._meta
+    field = meta_info.fields_map[relation]
+    related_model = field.related_model
+    related_pk = related_model._meta.pk_attr
+    if relation in meta_info.backward_fk_fields:
+        parent_key = field.relation_field
+    else:
+        assert relation in meta_info.m2m_fields, f"{model.__name__}.{relation} 不是反向外键或者多对多关系"
+        parent_key = f"{field.related_name}__{meta_info.pk_attr}"
+
+    kwargs = dict(slice_args)
+    first = kwargs.pop(SLICE_LIMIT_ARG, None)
+    if first is not None and first <= 0:
+        raise ValueError("first 必须大于0")
+    order_by = parse_order_by(related_model, kwargs.pop(SLICE_ORDER_ARG, None))
+    ret = {i.pk: [] for i in instances}
+    if not ret:
+        return ret
+
+    # values_list的列按位置命名为 "0" "1" ...，依次是 关联对象的主键、父对象的主键、排序用的列
+    values = [related_pk, parent_key] + [i for i, _ in order_by]
+    inner = related_model.filter(**{f"{parent_key}__in": list(ret)}, **kwargs).values_list(*values)
+    inner._make_query()
+    inner = inner.query
+    row_number = RowNumber().over(inner.field("1"))
+    for i, (_, order) in enumerate(order_by):
+        row_number = row_number.orderby(inner.field(str(i + 2)), order=order)
+    query_class = related_model._meta.db.query_class
+    window = query_class.from_(inner).select(inner.field("0"), inner.field("1"), row_number.as_("n"))
+    outer = query_class.from_(window).select(window.field("0"), window.field("1")) \
+        .orderby(window.field("1")).orderby(window.field("n"))
+    if first is not None:
+        outer = outer.where(window.field("n") <= first)
+    _, rows = await related_model._meta.db.execute_query(str(outer))
+    pairs = [(parent_pk, pk) for pk, parent_pk in rows]
+    if not pairs:
+        return ret
+
+    if query_set is None:
+        query_set = related_model.all()
+    objects = {i.pk: i async for i in query_set.filter(**{f"{related_pk}__in": list({pk for _, pk in pairs})})}
+    for parent_pk, pk in pairs:
+        if pk in objects:
+            ret[parent_pk].append(objects[pk])
+    return ret
+
+
+class RelationSliceLoader(BatchLoader):
+    """
+    带参数的关系字段没有被prefetch的时候（比如同一个关系用别名查了两种参数），
+    同一轮的请求仍然合并成一次切片查询
+    """
+
+    def __init__(self, model: Type[Model], relation: str, slice_args: Tuple,
+                 identity_map: Optional[IdentityMap] = None):
+        super().__init__()
+        self.model = model
+        self.relation = relation
+        self.slice_args = slice_args
+        self.identity_map = identity_map or IdentityMap()
+
+    async def batch_load(self, instances: List[Model]) -> Dict[Any, Any]:
+        slices = await fetch_relation_slice(self.model, self.relation, instances, self.slice_args)
+        return {k: self.identity_map.intern_list(v) for k, v in slices.items()}
+
+
+def get_loader(context, model: Type[Model], relation: str) -> RelationLoader:
+    """
+    取得请求内共享的加载器，加载器放在 context["loaders"] 里
+    加载出来的对象在 context["identity_map"] 里去重，共用加载器的几个查询也要共用identity map
+    """
+    loaders = context.setdefault("loaders", {})
+    key = (model, relation)
+    if key not in loaders:
+        loaders[key] = RelationLoader(model, relation, get_identity_map(context))
+    return loaders[key]
+
+
+def get_aggregate_loader(context, model: Type[Model], relation: str, function: str,
+                         column: Optional[str] = None) -> AggregateLoader:
+    loaders = context.setdefault("loaders", {})
+    key = (model, relation, function, column)
+    if key not in loaders:
+        loaders[key] = AggregateLoader(model, relation, function, column)
+    return loaders[key]
+
+
+def get_slice_loader(context, model: Type[Model], relation: str, slice_args: Tuple) -> RelationSliceLoader:
+    loaders = context.setdefault("loaders", {})
+    key = (model, relation, "slice", slice_args)
+    if key not in loaders:
+        loaders[key] = RelationSliceLoader(model, relation, slice_args, get_identity_map(context))
+    return loaders[key]
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   model_version.py
+@Time    :   2021/3/4 11:05
+@Desc    :   每个表一个单调递增的数据版本号，表被写的时候加一
+"""
+import os
+from collections import defaultdict, namedtuple
+from functools import wraps
+from typing import Type, Callable, List, Set, Optional
+from uuid import uuid4
+
+from tortoise import Model
+from tortoise.backends.base.client import BaseDBAsyncClient, TransactionContext, TransactionContextPooled
+from tortoise.backends.base.executor import BaseExecutor
+from tortoise.fields.relational import ManyToManyRelation
+from tortoise.queryset import UpdateQuery, DeleteQuery
+from tortoise.signals import Signals
+
+# 表名 -> 版本号
+_versions = defaultdict(int)
+# 版本号变化的时候通知这些回调，参数是表名
+_listeners: List[Callable[[str], None]] = []
+_watched = set()
+# (进程号, 随机串)，fork出来的进程要重新生成
+_epoch = None
+
+
+def get_table(model: Type[Model]) -> str:
+    return model._meta.db_table
+
+
+def get_version(table: str) -> int:
+    return _versions[table]
+
+
+def get_epoch() -> str:
+    """
+    版本号只在当前进程内有效，进程重启或者换了一个worker都会从0开始
+    ETag这种要拿到进程外比较的东西要带上它，免得不同进程的版本号碰巧相同
+    """
+    global _epoch
+    pid = os.getpid()
+    if _epoch is None or _epoch[0] != pid:
+        _epoch = (pid, uuid4().hex)
+    return _epoch[1]
+
+
+def get_cascade_tables(model: Type[Model], tables=None) -> Set[str]:
+    """
+    删除这个模型的行会写到的表：它自己、多对多的中间表，以及级联删除的反向外键
+    """
+    meta_info = model._meta
+    if tables is None:
+        tables = set()
+    tables.add(meta_info.db_table)
+    tables.update(meta_info.fields_map[i].through for i in meta_info.m2m_fields)
+    for name in meta_info.backward_fk_fields | meta_info.backward_o2o_fields:
+        related_model = meta_info.fields_map[name].related_model
+        if related_model._meta.db_table not in tables:
+            get_cascade_tables(related_model, tables)
+    return tables
+
+
+def bump(*tables: str):
+    for table in tables:
+        _versions[table] += 1
+    for listener in _listeners:
+        for table in tables:
+            listener(table)
+
+
+def bump_on(connection: Optional[BaseDBAsyncClient], *tables: str):
+    """
+    在事务里写的表要等事务结束之后再加版本号，否则并发的读可能在提交之前把旧数据按新的版本号缓存起来
+    不在事务里的话马上加
+    """
+    pending = getattr(connection, "_version_pending", None)
+    if pending is None:
+        bump(*tables)
+    else:
+        pending.update(tables)
+
+
+def add_listener(listener: Callable[[str], None]):
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+async def _on_save(sender, instance, created, using_db, *_):
+    bump_on(using_db or sender._meta.db, get_table(sender))
+
+
+async def _on_delete(sender, instance, using_db, *_):
+    bump_on(using_db or sender._meta.db, get_table(sender))
+
+
+def _patch_m2m_relation():
+    # 多对多的 add/remove/clear 只写中间表，不会触发任何信号，只能修补一下
+    if getattr(ManyToManyRelation, "_version_patched", False):
+        return
+
+    def patch(fn):
+        @wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            try:
+                return await fn(self, *args, **kwargs)
+            finally:
+                bump_on(kwargs.get("using_db") or self.remote_model._meta.db, self.field.through)
+
+        return wrapper
+
+    for name in ("add", "remove", "clear"):
+        setattr(ManyToManyRelation, name, patch(getattr(ManyToManyRelation, name)))
+    ManyToManyRelation._version_patched = True
+
+
+def _patch_queries():
+    # QuerySet.update/delete 和 Model.bulk_create 也不会触发信号
+    if getattr(BaseExecutor, "_version_patched", False):
+        return
+
+    def patch(cls, name, get_tables, get_connection):
+        fn = getattr(cls, name)
+
+        @wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            try:
+                return await fn(self, *args, **kwargs)
+            finally:
+                bump_on(get_connection(self), *get_tables(self.model))
+
+        setattr(cls, name, wrapper)
+
+    patch(UpdateQuery, "_execute", lambda model: {get_table(model)}, lambda query: query._db)
+    patch(DeleteQuery, "_execute", get_cascade_tables, lambda query: query._db)
+    patch(BaseExecutor, "execute_bulk_insert", lambda model: {get_table(model)}, lambda executor: executor.db)
+    BaseExecutor._version_patched = True
+
+
+def _patch_transactions():
+    # 最外层的事务开始的时候在连接上放一个集合，事务里写的表先记在这里，提交或者回滚之后再加版本号
+    # 嵌套的事务用的是 NestedTransactionContext，不会提交，写的表记在外层的集合里
+    if getattr(TransactionContext, "_version_patched", False):
+        return
+
+    def patch(cls):
+        enter, exit_ = cls.__aenter__, cls.__aexit__
+
+        @wraps(enter)
+        async def aenter(self):
+            self.connection._version_pending = set()
+            return await enter(self)
+
+        @wraps(exit_)
+        async def aexit(self, *args):
+            try:
+                return await exit_(self, *args)
+            finally:
+                pending = self.connection._version_pending
+                self.connection._version_pending = None
+                bump(*pending)
+
+        cls.__aenter__, cls.__aexit__ = aenter, aexit
+
+    patch(TransactionContext)
+    patch(TransactionContextPooled)
+    TransactionContext._version_patched = True
+
+
+def watch_model(model: Type[Model]):
+    """
+    通过tortoise的信号监听模型的写入，可以重复调用
+    不触发信号的写（多对多的add/remove、QuerySet.update/delete、bulk_create）靠修补tortoise来加版本号
+    事务里的写等事务结束之后才加版本号，见 bump_on
+    自己拼sql的写要自己调用 bump_on，比如 bulk
+    """
+    _patch_m2m_relation()
+    _patch_queries()
+    _patch_transactions()
+    if model in _watched:
+        return
+    _watched.add(model)
+    model.register_listener(Signals.post_save, _on_save)
+    model.register_listener(Signals.post_delete, _on_delete)
+
+
+class ReadInfo(namedtuple("ReadInfo", ("orm_type", "field_name"))):
+    """
+    记录一次查询读了哪个模型，如果 field_name 是多对多字段，那么还读了它的中间表
+    """
+
+    def get_tables(self) -> Set[str]:
+        meta_info = self.orm_type._meta
+        tables = {meta_info.db_table}
+        if self.field_name in meta_info.m2m_fields:
+            tables.add(meta_info.fields_map[self.field_name].through)
+        return tables
+
+
+def get_read_tables(plan) -> Set[str]:
+    """
+    从prefetch计划里收集查询会读到的表
+    """
+    tables = set()
+    for infos in plan.values():
+        for i in infos:
+            if isinstance(i, ReadInfo):
+                tables |= i.get_tables()
+    return tables
@@ -62,9 +62,10 @@ class Query(ObjectType):
         return f"hello {name}"
 
 
-schema = Schema(query=Query)
+if __name__ == "__main__":
+    schema = Schema(query=Query)
 
-query_string = '{ hello(name: "王超逸") me { fullName } }'
-result = schema.execute(query_string, backend=MyGraphQLBackend())
-print(result)
+    query_string = '{ hello(name: "王超逸") me { fullName } }'
+    result = schema.execute(query_string, backend=MyGraphQLBackend())
+    print(result)
 ...
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   query_cost.py
+@Time    :   2021/3/7 11:05
+@Desc    :   查询开销的静态估计，在执行之前就拒绝过大的查询
+"""
+from collections import namedtuple
+
+from graphql import GraphQLList, GraphQLNonNull, GraphQLObjectType
+from graphql.execution.utils import ExecutionContext, get_operation_root_type, collect_fields, get_field_def
+from graphql.pyutils.default_ordered_dict import DefaultOrderedDict
+
+# Necessary for static type checking
+from typing import Any, Optional
+
+# cost是估计会产生的字段值的个数（乘上字段的权重），depth是嵌套的层数
+QueryCost = namedtuple("QueryCost", ("cost", "depth"))
+
+# 这些参数的值被当作列表的长度
+SIZE_ARGS = ("page_size", "first")
+# 没有分页参数的列表（比如反向外键、多对多）估计的长度
+DEFAULT_LIST_SIZE = 10
+
+
+def unwrap_non_null(type_):
+    if isinstance(type_, GraphQLNonNull):
+        return type_.of_type
+    return type_
+
+
+def get_named_type(type_):
+    while isinstance(type_, (GraphQLNonNull, GraphQLList)):
+        type_ = type_.of_type
+    return type_
+
+
+def get_list_size(exe_context, field_def, field_ast):
+    # type: (ExecutionContext, Any, Any) -> Optional[int]
+    if not any(i in field_def.args for i in ("pageSize", "first")):
+        return None
+    args = exe_context.get_argument_values(field_def, field_ast)
+    for i in SIZE_ARGS:
+        if args.get(i) is not None:
+            return max(args[i], 0)
+    return None
+
+
+def estimate_cost(
+        exe_context,  # type: ExecutionContext
+        type_=None,  # type: Any
+        selection_set=None,  # type: Any
+        multiplier=1,  # type: int
+        list_size=None,  # type: Optional[int]
+        depth=1,  # type: int
+        default_list_size=DEFAULT_LIST_SIZE,  # type: int
+):
+    # type: (...) -> QueryCost
+    """
+    和 resolve_prefetch 一样遍历语法树，不访问数据库
+    每个字段的开销是 上层列表长度的乘积 * 字段的权重
+    字段的权重由类型上的 get_field_cost 决定，没有的话是1
+    list_size 是上一层的分页参数，留给下面第一个列表用，比如 xxxPage(first: 10) { items }
+    """
+    if type_ is None:
+        type_ = get_operation_root_type(exe_context.schema, exe_context.operation)
+    if selection_set is None:
+        selection_set = exe_context.operation.selection_set
+    fields = collect_fields(
+        exe_context, type_, selection_set, DefaultOrderedDict(list), set()
+    )
+    get_field_cost = getattr(getattr(type_, "graphene_type", None), "get_field_cost", None)
+    cost = 0
+    max_depth = depth
+    for response_name, field_asts in fields.items():
+        field_ast = field_asts[0]
+        field_name = field_ast.name.value
+        if field_name.startswith("__"):
+            continue
+        field_def = get_field_def(exe_context.schema, type_, field_name)
+        if not field_def:
+            continue
+        weight = get_field_cost(field_name) if get_field_cost else 1
+        cost += multiplier * weight
+        sub_type = get_named_type(field_def.type)
+        if not field_ast.selection_set or not isinstance(sub_type, GraphQLObjectType):
+            continue
+
+        size = get_list_size(exe_context, field_def, field_ast)
+        sub_multiplier = multiplier
+        sub_list_size = None
+        if isinstance(unwrap_non_null(field_def.type), GraphQLList):
+            if size is None:
+                size = default_list_size if list_size is None else list_size
+            sub_multiplier = multiplier * size
+        else:
+            sub_list_size = size
+        sub = estimate_cost(exe_context, sub_type, field_ast.selection_set, sub_multiplier,
+                            sub_list_size, depth + 1, default_list_size)
+        cost += sub.cost
+        max_depth = max(max_depth, sub.depth)
+    return QueryCost(cost, max_depth)
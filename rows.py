@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   rows.py
+@Time    :   2021/3/15 14:30
+@Desc    :   只读的快速路径：每一层一条 values_list 查询，结果直接装进带__slots__的行对象，不构造tortoise的模型
+"""
+from collections import namedtuple
+from functools import partial
+from operator import itemgetter
+from typing import Type, Dict, Tuple, Any, List, Optional
+
+from pypika import Table
+from tortoise import Model
+from tortoise.fields.relational import ManyToManyFieldInstance
+from tortoise.queryset import QuerySet
+
+from identity_map import IdentityMap
+
+# 数据库驱动返回的值已经是这些类型的话不需要再转换
+PLAIN_TYPES = (int, str, float)
+
+
+class Row(tuple):
+    """
+    所有行对象的基类，子类由 get_row_class 生成，是带上模型信息的namedtuple
+    列和关系都是属性，关系是已经加载好的行对象或者行对象的列表
+    """
+    __slots__ = ()
+    # 对应的tortoise模型
+    __model__: Type[Model] = None
+
+    @property
+    def pk(self):
+        raise NotImplementedError
+
+
+# (模型, 列, 关系) -> 行对象的类
+_row_classes: Dict[Tuple, type] = {}
+
+
+def get_row_class(model: Type[Model], fields: Tuple[str, ...], relations: Tuple[str, ...]) -> type:
+    key = (model, fields, relations)
+    row_class = _row_classes.get(key)
+    if row_class is None:
+        names = fields + relations
+        base = namedtuple(f"{model.__name__}Row", names)
+        row_class = type(base.__name__, (base, Row), {
+            "__slots__": (),
+            "__model__": model,
+            "pk": property(itemgetter(names.index(model._meta.pk_attr))),
+        })
+        _row_classes[key] = row_class
+    return row_class
+
+
+def get_row_fields(model: Type[Model], tree, selected) -> Tuple[str, ...]:
+    """
+    这一层要select的列：被查询的列、主键，以及加载关系要用到的键
+    selected里有None表示要整行，主键总是第一列
+    """
+    meta_info = model._meta
+    if None in selected:
+        fields = set(meta_info.fields_db_projection)
+    else:
+        fields = {i for i in selected if i in meta_info.fields_db_projection}
+    for name in tree:
+        field = meta_info.fields_map[name]
+        if name in meta_info.fk_fields or name in meta_info.o2o_fields:
+            fields.add(field.source_field)
+        elif name in meta_info.backward_fk_fields or name in meta_info.backward_o2o_fields:
+            fields.add(field.to_field_instance.model_field_name)
+    fields.discard(meta_info.pk_attr)
+    return (meta_info.pk_attr,) + tuple(sorted(fields))
+
+
+async def execute_values(query_set: QuerySet, values: Tuple[str, ...],
+                         through: Optional[Tuple[ManyToManyFieldInstance, list]] = None) -> List[tuple]:
+    """
+    只用tortoise生成sql，不经过它逐个字段的转换
+    through 是 (父对象上的多对多字段, 父对象的主键)，这时只join中间表来过滤，最后多一列父对象的主键
+    用 a__b__in 过滤的话tortoise会把父对象的表也join进来
+    """
+    meta_info = query_set.model._meta
+    query_set = query_set.values_list(*values)
+    query_set._make_query()
+    query = query_set.query
+    if through is not None:
+        field, keys = through
+        table = Table(field.through)
+        query = query.join(table).on(table[field.forward_key] == meta_info.basetable[meta_info.db_pk_column]) \
+            .where(table[field.backward_key].isin(keys)).select(table[field.backward_key])
+    _, rows = await meta_info.db.execute_query(str(query))
+    if rows and isinstance(rows[0], dict):
+        # mysql返回的是字典，values_list的列名是按位置的 "0" "1" ...
+        return [tuple(i.values()) for i in rows]
+    return [tuple(i) for i in rows]
+
+
+def group_rows(rows: List[tuple], keys: List[Any], many: bool) -> Dict[Any, Any]:
+    ret = {}
+    if many:
+        for row, key in zip(rows, keys):
+            ret.setdefault(key, []).append(row)
+    else:
+        for row, key in zip(rows, keys):
+            ret[key] = row
+    return ret
+
+
+def get_shape(model: Type[Model], tree, columns, prefix="") -> Tuple:
+    """
+    行对象的形状：这一层的列，以及每个关系下面的形状，形状一样的两个行对象，主键相同的话内容也一样
+    """
+    meta_info = model._meta
+    tree = {k: v for k, v in tree.items() if k in meta_info.fetch_fields}
+    fields = get_row_fields(model, tree, columns.get(prefix.rstrip("_"), set()))
+    return model, fields, tuple(
+        (name, get_shape(meta_info.fields_map[name].related_model, sub_tree, columns, prefix + name + "__"))
+        for name, sub_tree in tree.items()
+    )
+
+
+async def fetch_rows(query_set: QuerySet, tree, columns, prefix="", extra: Tuple[str, ...] = (),
+                     through: Optional[Tuple[ManyToManyFieldInstance, list]] = None,
+                     identity_map: Optional[IdentityMap] = None) -> Tuple[List[tuple], List[Any]]:
+    """
+    query_set 这一层的行，以及 tree 里的关系，tree 和 columns 的格式见 build_prefetch_tree 和 build_select_columns
+    先查这一层，再用这一层的键把每个关系查成一层，最后把关系按键拼到行上，所以sql的条数等于树的节点数
+    extra 是附带查询的一列，比如反向外键所属的父对象，through 见 execute_values
+    identity_map 里已经有的行直接复用，不再加载它下面的关系，外键指向的行也不再查询
+    返回 (行对象的列表, 每一行附带的父对象的键)
+    """
+    if identity_map is None:
+        identity_map = IdentityMap()
+    model = query_set.model
+    meta_info = model._meta
+    tree = {k: v for k, v in tree.items() if k in meta_info.fetch_fields}
+    shape = get_shape(model, tree, columns, prefix)
+    fields = shape[1]
+    raw = await execute_values(query_set, fields + extra, through)
+    width = len(fields)
+    has_extra = bool(extra) or through is not None
+    extra_values = [i[width] for i in raw] if has_extra else []
+
+    converters = [(i, meta_info.fields_map[name].to_python_value) for i, name in enumerate(fields)
+                  if meta_info.fields_map[name].field_type not in PLAIN_TYPES]
+    if converters or has_extra:
+        values = []
+        for i in raw:
+            i = list(i[:width])
+            for index, to_python in converters:
+                i[index] = to_python(i[index])
+            values.append(i)
+    else:
+        values = raw
+    # 只有还没有构造过的行需要加载关系
+    new_values = [i for i in values if (shape, i[0]) not in identity_map]
+
+    # 关系名 -> (这一行上的键所在的位置, 键 -> 关系的值, 是否是列表)
+    relations: List[Tuple[int, Dict[Any, Any], bool]] = []
+    for (name, sub_tree), (_, sub_shape) in zip(tree.items(), shape[2]):
+        field = meta_info.fields_map[name]
+        related_model = field.related_model
+        related_pk = related_model._meta.pk_attr
+        # 正向关系用关联对象的主键对应，反向外键和多对多用附带查出来的父对象的主键
+        sub_extra, sub_through = (), None
+        groups = {}
+        if name in meta_info.fk_fields or name in meta_info.o2o_fields:
+            key_index = fields.index(field.source_field)
+            keys = []
+            for key in {i[key_index] for i in new_values if i[key_index] is not None}:
+                row = identity_map.get((sub_shape, key))
+                if row is None:
+                    keys.append(key)
+                else:
+                    groups[key] = row
+            related_query_set = related_model.filter(**{f"{related_pk}__in": keys})
+            many = False
+        else:
+            if name in meta_info.m2m_fields:
+                key_index = 0
+            else:
+                key_index = fields.index(field.to_field_instance.model_field_name)
+            keys = list({i[key_index] for i in new_values if i[key_index] is not None})
+            if name in meta_info.m2m_fields:
+                related_query_set = related_model.all()
+                sub_through = (field, keys)
+            else:
+                related_query_set = related_model.filter(**{f"{field.relation_field}__in": keys})
+                sub_extra = (field.relation_field,)
+            many = name not in meta_info.backward_o2o_fields
+        if keys:
+            related_rows, related_keys = await fetch_rows(related_query_set, sub_tree, columns, prefix + name + "__",
+                                                          sub_extra, sub_through, identity_map)
+            if not many:
+                related_keys = related_keys or [i.pk for i in related_rows]
+            groups.update(group_rows(related_rows, related_keys, many))
+        relations.append((key_index, groups, many))
+
+    row_class = get_row_class(model, fields, tuple(tree))
+    if relations:
+        make = row_class._make
+
+        def build(i):
+            related = [groups.get(i[key_index], [] if many else None) for key_index, groups, many in relations]
+            return make((*i, *related))
+    else:
+        build = partial(tuple.__new__, row_class)
+    # 多对多的行属于几个父对象就会重复几次，别的路径上也可能加载过同一行，同一个主键只构造一次
+    rows = []
+    for i in values:
+        key = (shape, i[0])
+        row = identity_map.get(key)
+        if row is None:
+            row = build(i)
+            identity_map.set(key, row)
+        rows.append(row)
+    return rows, extra_values
+
+
+async def fetch_row_list(query_set: QuerySet, tree, columns,
+                         identity_map: Optional[IdentityMap] = None) -> List[Row]:
+    rows, _ = await fetch_rows(query_set, tree, columns, identity_map=identity_map)
+    return rows
+
+
+def get_model_type(parent) -> Type[Model]:
+    # 行对象的类型不是模型，要从 __model__ 取
+    if isinstance(parent, Row):
+        return parent.__model__
+    return type(parent)
+
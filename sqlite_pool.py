@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   sqlite_pool.py
+@Time    :   2021/3/10 15:20
+@Desc    :   带只读连接池的sqlite后端，在tortoise的配置里用 "engine": "sqlite_pool"
+"""
+import asyncio
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from typing import Any, List, Optional, Sequence, Tuple
+
+import aiosqlite
+from tortoise.backends.sqlite.client import SqliteClient, translate_exceptions
+
+from tracing import Histogram, ms
+
+
+class ReadPool:
+    """
+    只读连接池，每个aiosqlite连接有自己的线程，所以多个读可以真正地同时进行
+    记录取连接时等待的次数和时间
+    """
+
+    def __init__(self, connections: List[aiosqlite.Connection]):
+        self.connections = connections
+        self.queue: asyncio.Queue = asyncio.Queue()
+        for i in connections:
+            self.queue.put_nowait(i)
+        self.acquisitions = 0
+        # 取连接的时候池是空的，不得不等待的次数
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.wait_histogram = Histogram()
+
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        if self.queue.empty():
+            self.waits += 1
+        connection = await self.queue.get()
+        wait = time.perf_counter() - start
+        self.acquisitions += 1
+        self.wait_time += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.wait_histogram.observe(ms(wait))
+        try:
+            yield connection
+        finally:
+            self.queue.put_nowait(connection)
+
+    async def close(self):
+        for i in self.connections:
+            await i.close()
+        self.connections = []
+
+    def stats(self):
+        return {
+            "size": len(self.connections),
+            "idle": self.queue.qsize(),
+            "acquisitions": self.acquisitions,
+            "waits": self.waits,
+            "wait_time_ms": ms(self.wait_time),
+            "max_wait_ms": ms(self.max_wait),
+            "wait_histogram": self.wait_histogram.to_dict(),
+        }
+
+
+class PooledSqliteClient(SqliteClient):
+    """
+    一个写连接加上read_connections个只读连接
+    事务之外的SELECT走只读连接，其他的语句和事务里的语句都走写连接
+    只读连接要和写连接同时访问同一个文件，所以需要WAL模式，内存数据库不会开启连接池
+    """
+
+    def __init__(self, file_path: str, read_connections: int = 4, **kwargs: Any) -> None:
+        # read_connections要单独接收，其他参数都会被当作PRAGMA
+        super().__init__(file_path, **kwargs)
+        self.read_connections = int(read_connections)
+        self.read_pool: Optional[ReadPool] = None
+        if self.use_read_pool():
+            assert str(self.pragmas["journal_mode"]).upper() == "WAL", "只读连接池需要WAL模式"
+
+    def use_read_pool(self) -> bool:
+        return self.read_connections > 0 and self.filename != ":memory:"
+
+    async def create_read_connection(self) -> aiosqlite.Connection:
+        connection = aiosqlite.connect(f"file:{self.filename}?mode=ro", uri=True, isolation_level=None)
+        connection.start()
+        await connection._connect()
+        connection._conn.row_factory = sqlite3.Row
+        return connection
+
+    async def create_connection(self, with_db: bool) -> None:
+        await super().create_connection(with_db)
+        if self.read_pool is None and self.use_read_pool():
+            self.read_pool = ReadPool([await self.create_read_connection() for _ in range(self.read_connections)])
+            self.log.debug("Created %s read connections for %s", self.read_connections, self.filename)
+
+    async def close(self) -> None:
+        if self.read_pool is not None:
+            await self.read_pool.close()
+            self.read_pool = None
+        await super().close()
+
+    @staticmethod
+    def is_read(query: str) -> bool:
+        return query.lstrip()[:6].upper() == "SELECT"
+
+    def acquire_connection_for(self, query: str):
+        if self.read_pool is not None and self.is_read(query):
+            return self.read_pool.acquire()
+        return self.acquire_connection()
+
+    @translate_exceptions
+    async def execute_query(
+        self, query: str, values: Optional[list] = None
+    ) -> Tuple[int, Sequence[dict]]:
+        query = query.replace("\x00", "'||CHAR(0)||'")
+        async with self.acquire_connection_for(query) as connection:
+            self.log.debug("%s: %s", query, values)
+            start = connection.total_changes
+            rows = await connection.execute_fetchall(query, values)
+            return (connection.total_changes - start) or len(rows), rows
+
+    @translate_exceptions
+    async def execute_query_dict(self, query: str, values: Optional[list] = None) -> List[dict]:
+        query = query.replace("\x00", "'||CHAR(0)||'")
+        async with self.acquire_connection_for(query) as connection:
+            self.log.debug("%s: %s", query, values)
+            return list(map(dict, await connection.execute_fetchall(query, values)))
+
+    def pool_stats(self):
+        if self.read_pool is None:
+            return {"size": 0}
+        return self.read_pool.stats()
+
+
+client_class = PooledSqliteClient
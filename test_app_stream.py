@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   test_app_stream.py
+@Time    :   2021/3/18 10:10
+@Desc    :   流式输出只改变响应的写法，内容和顺序必须和一次输出的一样
+"""
+import asyncio
+import json
+
+import pytest
+from tortoise import Tortoise
+
+import app
+from graphgl_api import EventCurd
+from model import Tournament, Event, Team
+
+QUERIES = [
+    "{ eventList { id name } }",
+    "{ eventList(pageSize: 10, page: 1) { id } }",
+    "{ eventList(pageSize: 7, page: 2) { id name tournament { name } participants { name } } }",
+    "{ eventList(pageSize: 0) { id } }",
+    "{ a: eventList(pageSize: 4) { id } teamCount b: teamList { id events { id } } }",
+]
+
+
+class Response:
+    # 和sanic的StreamingHTTPResponse一样只需要write
+    def __init__(self):
+        self.parts = []
+
+    async def write(self, data):
+        self.parts.append(data)
+
+
+async def seed():
+    tournament = await Tournament.create(name="t")
+    teams = [await Team.create(name=f"team{i}") for i in range(3)]
+    for i in range(30):
+        # 名字的顺序和主键的顺序不一样
+        event = await Event.create(name=f"e{(i * 7) % 30:02d}", tournament=tournament)
+        await event.participants.add(*teams[:i % 4])
+
+
+async def execute_both(query):
+    expected = await app.execute_query({"query": query})
+    response = Response()
+    await app.stream_query(response, {"query": query})
+    return expected, json.loads("".join(response.parts))
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    # 游标字段不是主键，每段只有3行，流式输出要分很多段
+    monkeypatch.setattr(app, "SQLITE_FILE", str(tmp_path / "db.sqlite3"))
+    monkeypatch.setattr(EventCurd, "cursor_fields", ["name", "id"])
+    monkeypatch.setattr(EventCurd, "stream_chunk_size", 3)
+
+    def run(fn):
+        async def main():
+            await app.init_orm(generate_schemas=True)
+            try:
+                await seed()
+                return await fn()
+            finally:
+                await Tortoise.close_connections()
+
+        return asyncio.run(main())
+
+    return run
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_stream_same_as_buffered(run, query):
+    expected, actual = run(lambda: execute_both(query))
+    assert "errors" not in expected
+    assert actual == expected
+
+
+def test_list_ordered_by_cursor_fields(run):
+    expected, actual = run(lambda: execute_both("{ eventList(pageSize: 10, page: 1) { name } }"))
+    names = [i["name"] for i in actual["data"]["eventList"]]
+    assert names == [f"e{i:02d}" for i in range(10, 20)]
+    assert actual == expected
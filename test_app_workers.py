@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   test_app_workers.py
+@Time    :   2021/3/17 15:40
+@Desc    :   多进程模式的冒烟测试：启动两个worker，发请求，杀掉一个worker，检查它被重新启动并且还能处理请求
+"""
+import asyncio
+import json
+import os
+import queue
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def sanic_can_serve() -> bool:
+    # sanic 20.12 的服务器会调用 asyncio.Event(loop=...)，python 3.10 去掉了这个参数
+    try:
+        asyncio.Event(loop=None)
+    except TypeError:
+        return False
+    return True
+
+
+pytestmark = pytest.mark.skipif(not sanic_can_serve(), reason="安装的sanic在这个版本的python上不能启动服务器")
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def post_query(port: int, query: str, timeout=5):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/api/", data=json.dumps({"query": query}).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status, json.loads(response.read())
+
+
+def wait_for(fn, timeout=20):
+    # 反复调用fn，直到它不抛异常并且返回真值
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            ret = fn()
+            if ret:
+                return ret
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+        if time.monotonic() > deadline:
+            raise AssertionError("等待超时")
+        time.sleep(0.1)
+
+
+class Server:
+    """
+    在子进程里运行 app.py，stdout一行一行地收集起来
+    """
+
+    def __init__(self, env):
+        self.process = subprocess.Popen([sys.executable, "-u", os.path.join(ROOT, "app.py")], env=env, cwd=ROOT,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        self.lines = queue.Queue()
+        self.output = []
+        threading.Thread(target=self.read, daemon=True).start()
+
+    def read(self):
+        for line in self.process.stdout:
+            self.lines.put(line)
+
+    def expect(self, pattern, timeout=20):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=max(deadline - time.monotonic(), 0.01))
+            except queue.Empty:
+                raise AssertionError(f"没有等到 {pattern}，输出是:\n{''.join(self.output)}")
+            self.output.append(line)
+            match = re.search(pattern, line)
+            if match:
+                return match
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+
+@pytest.fixture
+def env(tmp_path):
+    env = dict(os.environ, SQLITE_FILE=str(tmp_path / "db.sqlite3"), GRAPHQL_PORT=str(get_free_port()),
+               GRAPHQL_HOST="127.0.0.1", GRAPHQL_WORKERS="2")
+    # 先建好表，worker启动的时候不会建表
+    subprocess.run([sys.executable, "-c", "import asyncio, app; from tortoise import Tortoise\n"
+                                          "async def main():\n"
+                                          "    await app.init_orm(generate_schemas=True)\n"
+                                          "    await Tortoise.close_connections()\n"
+                                          "asyncio.run(main())"],
+                   env=env, cwd=ROOT, check=True, stdout=subprocess.DEVNULL, timeout=60)
+    return env
+
+
+def test_workers_respawn(env):
+    port = int(env["GRAPHQL_PORT"])
+    server = Server(env)
+    try:
+        pids = [int(i) for i in re.findall(r"\d+", server.expect(r"启动了2个worker: \[(.*)\]").group(1))]
+        assert len(pids) == 2 and all(pid_alive(i) for i in pids)
+
+        wait_for(lambda: post_query(port, "{ teamCount }")[0] == 200)
+        status, body = post_query(port, 'mutation { teamBulkCreate(items: [{name: "a"}, {name: "b"}]) }')
+        assert status == 200 and body["data"]["teamBulkCreate"] == [1, 2]
+        for _ in range(10):
+            status, body = post_query(port, "{ teamList { name } }")
+            assert status == 200 and body["data"] == {"teamList": [{"name": "a"}, {"name": "b"}]}
+
+        os.kill(pids[0], signal.SIGKILL)
+        match = server.expect(rf"worker {pids[0]} 退出了.*重新启动为 (\d+)")
+        new_pid = int(match.group(1))
+        assert new_pid not in pids and pid_alive(new_pid) and pid_alive(pids[1])
+        assert not pid_alive(pids[0])
+        pids = [new_pid, pids[1]]
+        # 新的worker启动完之前，请求由另一个worker处理
+        for _ in range(10):
+            assert wait_for(lambda: post_query(port, "{ teamCount }"))[1]["data"] == {"teamCount": 2}
+    finally:
+        server.stop()
+    assert server.process.returncode == 0
+    time.sleep(0.5)
+    assert not any(pid_alive(i) for i in pids)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   test_graphene_executor.py
+@Time    :   2021/3/17 10:30
+@Desc    :   graphene_executor 和graphql-core原来的执行器对比，同一个查询的data和errors必须一样
+"""
+import asyncio
+
+import graphene
+from graphql.execution.executors.asyncio import AsyncioExecutor
+
+from graphene_backend import MyGraphQLBackend
+
+# 变更的执行顺序
+mutation_log = []
+
+
+async def later(value, delay=0.0):
+    await asyncio.sleep(delay)
+    return value
+
+
+def fail(*_):
+    raise ValueError("boom")
+
+
+async def fail_later(*_):
+    await asyncio.sleep(0)
+    raise ValueError("boom later")
+
+
+class Item(graphene.ObjectType):
+    name = graphene.String()
+    required = graphene.NonNull(graphene.String)
+    required_async = graphene.NonNull(graphene.String)
+    required_error = graphene.NonNull(graphene.String)
+    nullable_error = graphene.String()
+
+    def resolve_name(self, info):
+        return self["name"]
+
+    def resolve_required(self, info):
+        return self.get("required")
+
+    async def resolve_required_async(self, info):
+        return await later(self.get("required"))
+
+    resolve_required_error = staticmethod(fail_later)
+    resolve_nullable_error = staticmethod(fail)
+
+
+class Query(graphene.ObjectType):
+    item = graphene.Field(Item, args={"name": graphene.String(), "required": graphene.String()})
+    required_item = graphene.NonNull(Item)
+    items = graphene.List(graphene.NonNull(Item))
+    nullable_items = graphene.List(Item)
+    async_value = graphene.String()
+    error = graphene.String()
+
+    def resolve_item(self, info, name="a", required=None):
+        return {"name": name, "required": required}
+
+    def resolve_required_item(self, info):
+        return {"name": "r"}
+
+    async def resolve_items(self, info):
+        return [{"name": "x", "required": "1"}, {"name": "y"}]
+
+    def resolve_nullable_items(self, info):
+        return [{"name": "x", "required": "1"}, None, {"name": "z"}]
+
+    async def resolve_async_value(self, info):
+        return await later("v")
+
+    resolve_error = staticmethod(fail_later)
+
+
+class Append(graphene.Mutation):
+    class Arguments:
+        value = graphene.String(required=True)
+        delay = graphene.Float()
+
+    Output = graphene.String
+
+    async def mutate(self, info, value, delay=0.0):
+        # 先执行的字段等得更久，并发执行的话记录的顺序就会乱
+        await asyncio.sleep(delay)
+        mutation_log.append(value)
+        if value == "bad":
+            raise ValueError("bad value")
+        return value
+
+
+class Mutation(graphene.ObjectType):
+    append = Append.Field()
+    required_append = graphene.Field(graphene.NonNull(graphene.String), value=graphene.String(required=True))
+
+    def resolve_required_append(self, info, value):
+        mutation_log.append(value)
+        return None
+
+
+schema = graphene.Schema(query=Query, mutation=Mutation)
+
+
+def normalize(result):
+    # 同一层的字段是并发完成的，错误的顺序不重要
+    ret = result.to_dict()
+    if "errors" in ret:
+        ret["errors"] = sorted(ret["errors"], key=lambda i: str(i.get("path")))
+    return ret
+
+
+async def execute_both(query):
+    expected = await schema.execute(query, executor=AsyncioExecutor(), return_promise=True)
+    expected_log = list(mutation_log)
+    mutation_log.clear()
+    actual = await schema.execute(query, backend=MyGraphQLBackend(cache=None), context_value={})
+    actual_log = list(mutation_log)
+    mutation_log.clear()
+    return normalize(expected), normalize(actual), expected_log, actual_log
+
+
+def assert_same(query):
+    expected, actual, expected_log, actual_log = asyncio.run(execute_both(query))
+    assert actual == expected
+    assert actual_log == expected_log
+    return actual, actual_log
+
+
+def test_nullable_field_errors():
+    assert_same("{ item { name nullableError } asyncValue error }")
+
+
+def test_non_null_error_nulls_parent():
+    result, _ = assert_same("{ item { name requiredError } asyncValue }")
+    assert result["data"] == {"item": None, "asyncValue": "v"}
+
+
+def test_non_null_returning_null():
+    result, _ = assert_same('{ a: item { required } b: item(required: "x") { required requiredAsync } '
+                            "c: item { requiredAsync } }")
+    assert result["data"] == {"a": None, "b": {"required": "x", "requiredAsync": "x"}, "c": None}
+
+
+def test_non_null_list_items():
+    # 非空的项出错，整个列表变成null；可以为null的项只影响它自己
+    result, _ = assert_same("{ items { name required } nullableItems { name required } }")
+    assert result["data"]["items"] is None
+    assert result["data"]["nullableItems"] == [{"name": "x", "required": "1"}, None, None]
+
+
+def test_non_null_root_field():
+    result, _ = assert_same("{ requiredItem { name requiredError } asyncValue }")
+    assert result["data"] is None
+
+
+def test_mutation_order():
+    _, log = assert_same('mutation { a: append(value: "1", delay: 0.03) b: append(value: "2", delay: 0.01) '
+                         'c: append(value: "3") }')
+    assert log == ["1", "2", "3"]
+
+
+def test_mutation_errors():
+    result, log = assert_same('mutation { a: append(value: "bad", delay: 0.01) b: append(value: "2") }')
+    assert result["data"] == {"a": None, "b": "2"}
+    assert log == ["bad", "2"]
+
+
+def test_non_null_mutation_stops_later_fields():
+    result, log = assert_same('mutation { a: requiredAppend(value: "1") b: append(value: "2") }')
+    assert result["data"] is None
+    assert log == ["1"]
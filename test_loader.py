@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   test_loader.py
+@Time    :   2021/3/18 14:20
+@Desc    :   BatchLoader 的合并、出错和取消，dispatch的任务被取消了等待的resolver也不能一直挂着
+"""
+import asyncio
+
+import pytest
+
+from loader import BatchLoader
+
+
+class Row:
+    def __init__(self, pk):
+        self.pk = pk
+
+
+class SlowLoader(BatchLoader):
+    def __init__(self, error=None):
+        super().__init__()
+        self.error = error
+        self.batches = []
+
+    async def batch_load(self, instances):
+        self.batches.append(sorted(i.pk for i in instances))
+        await asyncio.sleep(0.01)
+        if self.error is not None:
+            raise self.error
+        return {i.pk: i.pk * 10 for i in instances}
+
+
+def test_batch_and_cache():
+    async def main():
+        loader = SlowLoader()
+        values = await asyncio.gather(*[loader.load(Row(i % 3)) for i in range(6)])
+        assert values == [0, 10, 20, 0, 10, 20]
+        assert await loader.load(Row(1)) == 10
+        assert loader.batches == [[0, 1, 2]]
+        assert not loader.tasks
+
+    asyncio.run(main())
+
+
+def test_batch_error():
+    async def main():
+        loader = SlowLoader(ValueError("boom"))
+        with pytest.raises(ValueError):
+            await asyncio.gather(loader.load(Row(1)), loader.load(Row(2)))
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("delay", [0, 0.005])
+def test_cancelled_dispatch(delay):
+    # delay为0的时候任务还没开始执行就被取消了
+    async def main():
+        loader = SlowLoader()
+        futures = [loader.load(Row(1)), loader.load(Row(2))]
+        await asyncio.sleep(0)
+        await asyncio.sleep(delay)
+        (task,) = loader.tasks
+        task.cancel()
+        for future in futures:
+            with pytest.raises(asyncio.CancelledError):
+                await asyncio.wait_for(future, 1)
+        assert not loader.tasks
+
+    asyncio.run(main())
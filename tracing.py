@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+"""
+@Author  :   王超逸
+@File    :   tracing.py
+@Time    :   2021/3/8 9:30
+@Desc    :   请求级的性能统计，结果放在 extensions.tracing 里，同时汇总成进程内的直方图
+"""
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Optional, Dict, List
+
+from graphql import MiddlewareManager
+from promise import is_thenable
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+# 当前请求的tracer，gather出来的子任务会继承同一个
+_current_tracer: ContextVar[Optional["Tracer"]] = ContextVar("tracer", default=None)
+
+# 这些方法会真正执行sql
+SQL_METHODS = ("execute_insert", "execute_many", "execute_query", "execute_query_dict", "execute_script")
+
+
+def ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+class Histogram:
+    """
+    固定分桶的直方图，分桶是按毫秒定的
+    """
+    buckets = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        # 最后一个桶是 +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        buckets = OrderedDict()
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        return {"count": self.count, "sum": round(self.sum, 3), "buckets": buckets}
+
+
+# 指标名 -> 直方图
+histograms: Dict[str, Histogram] = {}
+
+
+def observe(name: str, value: float):
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = Histogram()
+    histogram.observe(value)
+
+
+def export_histograms():
+    return {k: v.to_dict() for k, v in sorted(histograms.items())}
+
+
+class Tracer:
+    """
+    记录一个请求里各阶段的耗时、每个字段resolve的次数和耗时、sql的条数和耗时
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.duration = None
+        # 阶段名 -> 秒
+        self.phases: Dict[str, float] = OrderedDict()
+        # 类型名.字段名 -> [次数, 秒]
+        self.resolvers: Dict[str, List] = {}
+        self.sql_count = 0
+        self.sql_time = 0.0
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    def add_resolver(self, key: str, seconds: float):
+        item = self.resolvers.get(key)
+        if item is None:
+            self.resolvers[key] = [1, seconds]
+        else:
+            item[0] += 1
+            item[1] += seconds
+
+    def add_sql(self, seconds: float):
+        self.sql_count += 1
+        self.sql_time += seconds
+
+    def finish(self):
+        # 结束计时并汇总到直方图，只能调用一次
+        assert self.duration is None, "tracer已经结束了"
+        self.duration = time.perf_counter() - self.start
+        observe("request", ms(self.duration))
+        for k, v in self.phases.items():
+            observe(f"phase.{k}", ms(v))
+        for k, (count, seconds) in self.resolvers.items():
+            observe(f"resolver.{k}", ms(seconds))
+        observe("sql.count", self.sql_count)
+        observe("sql.duration", ms(self.sql_time))
+
+    def to_dict(self):
+        duration = self.duration if self.duration is not None else time.perf_counter() - self.start
+        return {
+            "duration": ms(duration),
+            "phases": {k: ms(v) for k, v in self.phases.items()},
+            "resolvers": {k: {"count": count, "duration": ms(seconds)}
+                          for k, (count, seconds) in self.resolvers.items()},
+            "sql": {"count": self.sql_count, "duration": ms(self.sql_time)},
+        }
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _current_tracer.get()
+
+
+@contextmanager
+def trace():
+    """
+    在with块里开启统计，块结束的时候汇总到直方图
+    """
+    patch_db_clients()
+    tracer = Tracer()
+    token = _current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _current_tracer.reset(token)
+        tracer.finish()
+
+
+@contextmanager
+def _null_phase():
+    yield
+
+
+def phase(name: str):
+    # 没有开启统计的时候什么都不做
+    tracer = _current_tracer.get()
+    if tracer is None:
+        return _null_phase()
+    return tracer.phase(name)
+
+
+class TracingMiddleware:
+    """
+    graphql的中间件，统计每个字段resolve的次数和耗时
+    异步的resolve从调用开始算到完成，包含了等待其他协程的时间
+    """
+
+    def resolve(self, next_, root, info, **kwargs):
+        tracer = _current_tracer.get()
+        if tracer is None:
+            return next_(root, info, **kwargs)
+        key = f"{info.parent_type.name}.{info.field_name}"
+        start = time.perf_counter()
+        result = next_(root, info, **kwargs)
+        if is_thenable(result):
+            return self.wait(tracer, key, start, result)
+        tracer.add_resolver(key, time.perf_counter() - start)
+        return result
+
+    @staticmethod
+    async def wait(tracer: Tracer, key: str, start: float, result):
+        try:
+            return await result
+        finally:
+            tracer.add_resolver(key, time.perf_counter() - start)
+
+
+def get_middleware() -> MiddlewareManager:
+    # 不能包成promise，原生执行器只对真正需要等待的值await
+    return MiddlewareManager(TracingMiddleware(), wrap_in_promise=False)
+
+
+def wrap_sql_method(fn):
+    @wraps(fn)
+    async def wrapper(self, *args, **kwargs):
+        tracer = _current_tracer.get()
+        if tracer is None:
+            return await fn(self, *args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return await fn(self, *args, **kwargs)
+        finally:
+            tracer.add_sql(time.perf_counter() - start)
+
+    wrapper.__traced__ = True
+    return wrapper
+
+
+def patch_db_clients(cls=BaseDBAsyncClient):
+    """
+    给所有数据库客户端执行sql的方法加上计时
+    客户端的模块是 Tortoise.init 的时候才导入的，所以每次开启统计的时候都检查一遍
+    """
+    for subclass in cls.__subclasses__():
+        for name in SQL_METHODS:
+            fn = subclass.__dict__.get(name)
+            if fn is not None and not getattr(fn, "__traced__", False):
+                setattr(subclass, name, wrap_sql_method(fn))
+        patch_db_clients(subclass)